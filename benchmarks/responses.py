@@ -0,0 +1,45 @@
+"""
+CPU cost of encoding a 250-row /characters/ page with FastAPI's default
+encoder (`jsonable_encoder` + `json`) and with `json_response` in both
+formats. Run from the repository root:
+
+    python -m benchmarks.responses
+"""
+import time
+from decimal import Decimal
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from src.api.responses import response_formats, table_response
+
+NAMES = ["character_id", "character", "movie", "gender", "number_of_lines", "imdb_rating"]
+ROWS = [(i, f"CHARACTER {i}", f"movie title {i % 40}", "M", i * 3, Decimal("7.5")) for i in range(250)]
+
+
+def cpu_time(fn, repeat=200):
+    """Returns the best CPU time of `repeat` calls to `fn`, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        fn()
+        best = min(best, time.process_time() - start)
+    return best
+
+
+def main():
+    content = [dict(zip(NAMES, row)) for row in ROWS]
+    cases = {
+        "jsonable_encoder + json": lambda: JSONResponse(jsonable_encoder(content)),
+        "orjson rows": lambda: table_response(NAMES, ROWS),
+        "orjson columnar": lambda: table_response(NAMES, ROWS, response_formats.columnar),
+    }
+    default = None
+    for name, fn in cases.items():
+        seconds = cpu_time(fn)
+        default = default or seconds
+        print(f"{name:<25} {seconds * 1000:8.3f} ms  {default / seconds:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
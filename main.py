@@ -1,8 +1,111 @@
+import gc
+import os
+import random
+import signal
+import socket
+
+import dotenv
 import uvicorn
 
-if __name__ == "__main__":
+HOST = os.environ.get("HOST", "127.0.0.1")
+PORT = int(os.environ.get("PORT", "3000"))
+
+
+def run_development():
     config = uvicorn.Config(
-        "src.api.server:app", port=3000, log_level="info", reload=True, env_file=".env"
+        "src.api.server:app", host=HOST, port=PORT, log_level="info", reload=True, env_file=".env"
     )
     server = uvicorn.Server(config)
     server.run()
+
+
+def preload():
+    """
+    Loads the app and everything it keeps in memory once, in the master
+    process, so forked workers share it copy-on-write.
+    """
+    from src import autocomplete, dialogue_stats, graph, inverted_index, words
+    from src.api import server
+
+    graph.get_graph()
+    words.get_index()
+    dialogue_stats.get_stats()
+    autocomplete.get_index()
+    inverted_index.get_index()
+
+    # Keep the preloaded objects out of the garbage collector's reach so
+    # collections in the workers do not touch (and copy) their pages.
+    gc.freeze()
+    return server.app
+
+
+def run_worker(app, sock):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    # Jitter the request limit so workers are not all recycled at once.
+    max_requests = int(os.environ.get("MAX_REQUESTS", "10000"))
+    max_requests += random.randint(0, max_requests // 10)
+    config = uvicorn.Config(app, log_level="info", limit_max_requests=max_requests)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def run_production():
+    dotenv.load_dotenv(".env")
+    app = preload()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, PORT))
+    sock.listen(2048)
+
+    num_workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+    workers = set()
+    running = True
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(app, sock)
+            finally:
+                os._exit(0)
+        workers.add(pid)
+
+    def shutdown(signum, frame):
+        nonlocal running
+        running = False
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for _ in range(num_workers):
+        spawn()
+
+    # Replace workers as they exit, e.g. after reaching MAX_REQUESTS.
+    while workers:
+        pid, _ = os.wait()
+        workers.discard(pid)
+        if running:
+            spawn()
+
+
+def setup_schema():
+    """Creates the tables and indexes the app needs once, before any worker starts."""
+    from src import database as db
+
+    db.ensure_schema()
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv(".env")
+    setup_schema()
+
+    # SERVER_MODE=production preloads the data once and forks
+    # WEB_CONCURRENCY workers; the default is a single reloading process.
+    if os.environ.get("SERVER_MODE", "development") == "production":
+        run_production()
+    else:
+        run_development()
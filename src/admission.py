@@ -0,0 +1,176 @@
+import asyncio
+import math
+import os
+import time
+
+from fastapi import Depends, HTTPException, Request
+
+from src import cancellation
+from src import database as db
+
+
+class RouteClass:
+    """
+    Admission control for a group of routes with a similar cost.
+
+    At most `max_concurrent` requests of the class run at once and at most
+    `max_queue` more wait for a slot. A request that finds the queue full is
+    rejected right away with a 429; one that waits longer than
+    `queue_timeout` seconds gets a 503. Queries issued while the request
+    runs are cancelled by Postgres after `statement_timeout_ms`.
+
+    Requests also have a deadline, `deadline` seconds after they arrive
+    (0 for none) or sooner if the client sends an `X-Request-Timeout`
+    header. Once it passes, or once the client disconnects when
+    `cancel_on_disconnect` is set, the request's running query is
+    cancelled so its connection goes back to the pool.
+    """
+
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout, statement_timeout_ms,
+                 deadline=0, cancel_on_disconnect=False):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.statement_timeout_ms = statement_timeout_ms
+        self.deadline = deadline
+        self.cancel_on_disconnect = cancel_on_disconnect
+        self._waiting = 0
+        self._semaphore = None
+
+    async def acquire(self, timeout=None):
+        # Created lazily so the semaphore belongs to the server's event loop.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        if self._semaphore.locked() and self._waiting >= self.max_queue:
+            raise HTTPException(
+                status_code=429,
+                detail=f"too many {self.name} requests, try again later.",
+                headers={"Retry-After": "1"},
+            )
+
+        self._waiting += 1
+        # Not `asyncio.wait_for`: before Python 3.12 it can be cancelled just
+        # as the acquire succeeds and lose the permit.
+        acquiring = asyncio.ensure_future(self._semaphore.acquire())
+        try:
+            done, _ = await asyncio.wait([acquiring], timeout=self.queue_timeout if timeout is None else timeout)
+        except asyncio.CancelledError:
+            self._abandon(acquiring)
+            raise
+        finally:
+            self._waiting -= 1
+        if not done:
+            self._abandon(acquiring)
+            raise HTTPException(
+                status_code=503,
+                detail=f"server is busy with {self.name} requests, try again later.",
+                headers={"Retry-After": "1"},
+            )
+
+    def _abandon(self, acquiring):
+        """Cancels a pending acquire, handing back the permit if it got one anyway."""
+        def release_if_acquired(task):
+            if not task.cancelled() and task.exception() is None:
+                self._semaphore.release()
+
+        acquiring.cancel()
+        acquiring.add_done_callback(release_if_acquired)
+
+    def release(self):
+        self._semaphore.release()
+
+
+def _env(name, default, cast):
+    return cast(os.environ.get(name, default))
+
+
+route_classes = {
+    name: RouteClass(
+        name,
+        max_concurrent=_env(f"{name.upper()}_MAX_CONCURRENT", max_concurrent, int),
+        max_queue=_env(f"{name.upper()}_MAX_QUEUE", max_queue, int),
+        queue_timeout=_env(f"{name.upper()}_QUEUE_TIMEOUT", queue_timeout, float),
+        statement_timeout_ms=_env(f"{name.upper()}_STATEMENT_TIMEOUT_MS", statement_timeout_ms, int),
+        deadline=_env(f"{name.upper()}_DEADLINE", deadline, float),
+        cancel_on_disconnect=cancel_on_disconnect,
+    )
+    for name, max_concurrent, max_queue, queue_timeout, statement_timeout_ms, deadline, cancel_on_disconnect in (
+        # Point lookups and in-memory indexes.
+        ("cheap", 24, 64, 1.0, 2000, 5.0, True),
+        # Text searches and per-line joins in /lines.
+        ("expensive", 4, 8, 0.5, 10000, 15.0, True),
+        # Writes run to completion once started, even if the client leaves.
+        ("write", 8, 32, 2.0, 5000, 10.0, False),
+        # Full table streams; the timeout applies to each cursor fetch and
+        # the stream itself stops when the client disconnects.
+        ("export", 2, 4, 0.5, 30000, 0, False),
+    )
+}
+
+
+def request_deadline(request, route_class):
+    """
+    Returns the `time.monotonic()` deadline of `request`: the route class
+    default, shortened by a finite, positive `X-Request-Timeout` header (in
+    seconds).
+    """
+    timeouts = [route_class.deadline] if route_class.deadline else []
+    try:
+        header = float(request.headers.get("x-request-timeout", ""))
+        if math.isfinite(header) and header > 0:
+            timeouts.append(header)
+    except ValueError:
+        pass
+    return time.monotonic() + min(timeouts) if timeouts else None
+
+
+async def watch(request, route_class, deadline, tracker):
+    """Cancels the request's queries at its deadline or when the client leaves."""
+    async def disconnected():
+        # The handlers do not read the body after this point, so the next
+        # message on an open connection is the disconnect.
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+
+    timeout = None if deadline is None else max(0, deadline - time.monotonic())
+    if route_class.cancel_on_disconnect:
+        waiter = disconnected()
+    elif timeout is not None:
+        waiter = asyncio.sleep(timeout)
+    else:
+        return
+    try:
+        await asyncio.wait_for(waiter, timeout)
+    except asyncio.TimeoutError:
+        pass
+    await asyncio.to_thread(tracker.cancel)
+
+
+def limit(name):
+    """
+    Dependency that puts a router's requests under the admission control
+    of the route class `name`.
+    """
+    route_class = route_classes[name]
+
+    async def admit(request: Request):
+        deadline = request_deadline(request, route_class)
+        queue_timeout = route_class.queue_timeout
+        if deadline is not None:
+            queue_timeout = max(0, min(queue_timeout, deadline - time.monotonic()))
+        await route_class.acquire(queue_timeout)
+
+        tracker = cancellation.QueryTracker()
+        db.statement_timeout.set(route_class.statement_timeout_ms)
+        db.request_deadline.set(deadline)
+        cancellation.query_tracker.set(tracker)
+        watcher = asyncio.ensure_future(watch(request, route_class, deadline, tracker))
+        try:
+            yield
+        finally:
+            watcher.cancel()
+            route_class.release()
+
+    return Depends(admit)
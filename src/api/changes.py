@@ -0,0 +1,72 @@
+from fastapi import APIRouter
+from fastapi.params import Query
+from src import admission
+from src import database as db
+import sqlalchemy
+
+router = APIRouter(dependencies=[admission.limit("cheap")])
+
+
+@router.get("/changes", tags=["conversations"])
+def list_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    """
+    This endpoint is a feed of the conversations added through
+    `/movies/{movie_id}/conversations/`, oldest first, for services that
+    keep a copy of the corpus. It returns:
+    * `changes`: the conversations added after the change token `since`.
+    * `next`: the token to pass as `since` to get the following changes.
+    * `latest`: the token of the most recent change.
+    * `has_more`: whether more changes are waiting after `next`.
+
+    Each change is represented by a dictionary with the following keys:
+    * `token`: the change token, which increases with every change.
+    * `conversation`: the new row of the `conversations` table.
+    * `lines`: the new rows of the `lines` table, in `line_sort` order.
+
+    To start a copy, read `latest`, download the tables from `/export`,
+    then follow the feed from that token. Every row carries its id, so
+    applying a change twice is harmless.
+
+    The `limit` query parameter sets the maximum number of changes returned.
+    """
+    page = sqlalchemy.select(db.changes.c.change_id, db.changes.c.conversation_id)\
+        .where(db.changes.c.change_id > since)\
+        .order_by(db.changes.c.change_id)\
+        .limit(limit + 1)
+
+    with db.read_engine().connect() as conn:
+        latest = conn.execute(sqlalchemy.select(sqlalchemy.func.max(db.changes.c.change_id))).scalar() or 0
+        changes = conn.execute(page).fetchall()
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        conversation_ids = [row.conversation_id for row in changes]
+
+        conversations = {
+            row.conversation_id: dict(row._mapping)
+            for row in conn.execute(
+                sqlalchemy.select(db.conversations)
+                .where(db.conversations.c.conversation_id.in_(conversation_ids)))
+        }
+        lines = {conversation_id: [] for conversation_id in conversation_ids}
+        for row in conn.execute(
+                sqlalchemy.select(db.lines)
+                .where(db.lines.c.conversation_id.in_(conversation_ids))
+                .order_by(db.lines.c.conversation_id, db.lines.c.line_sort)):
+            lines[row.conversation_id].append(dict(row._mapping))
+
+    return {
+        "changes": [
+            {
+                "token": row.change_id,
+                "conversation": conversations.get(row.conversation_id),
+                "lines": lines[row.conversation_id],
+            }
+            for row in changes
+        ],
+        "next": changes[-1].change_id if changes else since,
+        "latest": latest,
+        "has_more": has_more,
+    }
@@ -1,47 +1,243 @@
 from fastapi import APIRouter, HTTPException
 from enum import Enum
+from typing import List, Optional
 
 from fastapi.params import Query
+from src import admission
+from src import cache
+from src import autocomplete
 from src import database as db
+from src import graph
+from src import words
+from src.api.responses import json_response, response_formats, table_response
 import sqlalchemy
 
 
-router = APIRouter()
+router = APIRouter(dependencies=[admission.limit("cheap")])
 
 
-def get_top_conv_characters(id, conn):
-    all_convs = sqlalchemy.select(
-        db.conversations.c.conversation_id,
-        db.conversations.c.character1_id.label("c1_id"),
-        db.conversations.c.character2_id.label("c2_id")
-    ).where((db.conversations.c.character1_id == id)
-            | (db.conversations.c.character2_id == id))
-    all_convs = conn.execute(all_convs).fetchall()
-
-    top_conversations = {}
-    for conv in all_convs:
-
-        other_id = conv.c1_id if conv.c1_id != id else conv.c2_id
-        if other_id in top_conversations.keys():
-            top_conversations[other_id]["number_of_lines_together"] += db.conv_to_num_lines.get(conv[0])
-        else:  # Initialize
-            other_info = sqlalchemy.select(
-                db.characters.c.name,
-                db.characters.c.gender
-            ).where(db.characters.c.character_id == other_id)
-            other_info = conn.execute(other_info).fetchone()
-            top_conversations[other_id] = {
+def character_summaries(ids, conn):
+    """
+    Looks up the name and gender of every character in `ids` with one query.
+    """
+    ids = list(set(ids))
+    if len(ids) == 0:
+        return {}
+    stmt = sqlalchemy.select(
+        db.characters.c.character_id,
+        db.characters.c.name,
+        db.characters.c.gender
+    ).where(db.characters.c.character_id.in_(ids))
+    return {row.character_id: row for row in conn.execute(stmt)}
+
+
+def get_top_conv_characters_batch(ids, conn):
+    """
+    Computes `top_conversations` for every character in `ids` from the
+    interaction graph, with a single query for the partners' names.
+    Returns a dict keyed by character id.
+    """
+    interactions = graph.get_graph()
+    neighbors = {id_: interactions.neighbors(id_) for id_ in set(ids)}
+    others = character_summaries(
+        [other_id for partners in neighbors.values() for other_id, _ in partners], conn)
+
+    return {
+        id_: [
+            {
                 "character_id": other_id,
-                "character": other_info.name,
-                "gender": other_info.gender,
-                "number_of_lines_together": db.conv_to_num_lines.get(conv.conversation_id)
+                "character": others[other_id].name,
+                "gender": others[other_id].gender,
+                "number_of_lines_together": lines_together
             }
-    top_conversations = list(top_conversations.values())
-    top_conversations.sort(key=lambda x: (-x["number_of_lines_together"], x["character_id"]))
-    return top_conversations
+            for other_id, lines_together in partners
+            if other_id in others
+        ]
+        for id_, partners in neighbors.items()
+    }
+
+
+def get_top_conv_characters(id, conn):
+    return get_top_conv_characters_batch([id], conn)[id]
+
+
+def get_characters_by_ids(ids, conn):
+    """
+    Builds the `get_character` payload for every id in `ids` using two
+    queries, no matter how many characters are requested. Returns a dict
+    keyed by character id; ids that do not exist are left out.
+    """
+    character_info = sqlalchemy.select(
+        db.characters.c.character_id,
+        db.characters.c.name,
+        db.characters.c.gender,
+        db.movies.c.title,
+    ).join(
+        db.movies,
+        db.characters.c.movie_id == db.movies.c.movie_id
+    ).where(db.characters.c.character_id.in_(list(set(ids))))
+    character_info = conn.execute(character_info).fetchall()
+
+    top_conversations = get_top_conv_characters_batch(
+        [row.character_id for row in character_info], conn)
+
+    return {
+        row.character_id: {
+            "character_id": row.character_id,
+            "character": row.name,
+            "movie": row.title,
+            "gender": row.gender,
+            "top_conversations": top_conversations[row.character_id]
+        }
+        for row in character_info
+    }
+
+
+@router.get("/characters/batch", tags=["characters"])
+@cache.cached()
+def get_characters(ids: List[int] = Query(..., max_items=250)):
+    """
+    This endpoint returns several characters at once. Pass each character id
+    as a repeated `ids` query parameter, e.g. `/characters/batch?ids=2&ids=7421`.
+
+    Each character has exactly the same shape as the response of
+    `/characters/{id}`. Characters are returned in the order their ids were
+    given; ids that do not match a character are skipped.
+    """
+    with db.read_engine().connect() as conn:
+        characters = get_characters_by_ids(ids, conn)
+
+    return json_response([characters[id_] for id_ in dict.fromkeys(ids) if id_ in characters])
+
+
+@router.get("/characters/autocomplete", tags=["characters"])
+def autocomplete_characters(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(10, ge=1, le=50),
+):
+    """
+    This endpoint suggests characters for a search box. It returns the
+    characters with a word in their name that starts with `q` (ignoring
+    case, accents and punctuation), those with the most lines first.
+
+    For each character it returns:
+    * `character_id`: the internal id of the character.
+    * `character`: The name of the character.
+    * `movie_id`: the internal id of the movie the character is from.
+    * `movie`: The title of the movie.
+    * `number_of_lines`: The number of lines the character has in the movie.
+
+    The `limit` query parameter sets the maximum number of suggestions.
+    """
+    return autocomplete.get_index().complete_characters(q, limit)
+
+
+@router.get("/characters/{id}/neighbors", tags=["characters"])
+def get_character_neighbors(id: int):
+    """
+    This endpoint returns every character that the character whose id is
+    given has had a conversation with. For each of them it returns:
+    * `character_id`: the internal id of the character.
+    * `character`: The name of the character.
+    * `gender`: The gender of the character.
+    * `number_of_lines_together`: The number of lines spoken in all of
+      their conversations together.
+
+    The characters are ordered by `number_of_lines_together`, highest to
+    lowest.
+    """
+    with db.read_engine().connect() as conn:
+        if not character_summaries([id], conn):
+            raise HTTPException(status_code=404, detail="character not found.")
+        json = get_top_conv_characters(id, conn)
+    return json
+
+
+@router.get("/characters/{id}/top_partners", tags=["characters"])
+def get_character_top_partners(id: int, k: int = Query(5, ge=1, le=100)):
+    """
+    This endpoint returns the `k` characters that the character whose id is
+    given has spoken the most lines with. Each partner has the same keys as
+    in `/characters/{id}/neighbors`.
+    """
+    partners = graph.get_graph().top_partners(id, k)
+    with db.read_engine().connect() as conn:
+        others = character_summaries([id] + [other_id for other_id, _ in partners], conn)
+    if id not in others:
+        raise HTTPException(status_code=404, detail="character not found.")
+
+    return [
+        {
+            "character_id": other_id,
+            "character": others[other_id].name,
+            "gender": others[other_id].gender,
+            "number_of_lines_together": lines_together
+        }
+        for other_id, lines_together in partners
+        if other_id in others
+    ]
+
+
+@router.get("/characters/{id}/path/{other_id}", tags=["characters"])
+def get_interaction_path(id: int, other_id: int):
+    """
+    This endpoint returns the shortest chain of conversations linking two
+    characters from the same movie. Each step of the path is a character
+    who spoke with the one before it:
+    * `character_id`: the internal id of the character.
+    * `character`: The name of the character.
+
+    The path starts with `id` and ends with `other_id`. A 404 is returned if
+    either character has no conversations, and a 400 if they are from
+    different movies.
+    """
+    interactions = graph.get_graph()
+    movie_id = interactions.movie_of.get(id)
+    other_movie_id = interactions.movie_of.get(other_id)
+    if movie_id is None or other_movie_id is None:
+        raise HTTPException(status_code=404, detail="character(s) not found.")
+    if movie_id != other_movie_id:
+        raise HTTPException(status_code=400, detail="characters are not from the same movie.")
+
+    path = interactions.shortest_path(id, other_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="characters are not connected.")
+
+    with db.read_engine().connect() as conn:
+        names = character_summaries(path, conn)
+    return [
+        {"character_id": character_id, "character": names[character_id].name}
+        for character_id in path
+    ]
+
+
+@router.get("/characters/{id}/words", tags=["characters"])
+def get_character_words(id: int, limit: int = Query(25, ge=1, le=250)):
+    """
+    This endpoint returns vocabulary statistics for the lines spoken by a
+    character:
+    * `character_id`: the internal id of the character.
+    * `total_words`: The number of words the character has spoken.
+    * `unique_words`: The number of distinct words the character has spoken.
+    * `top_words`: The character's most frequent words, highest count first.
+    * `distinctive_words`: The words most over-represented in the
+      character's lines compared to the whole corpus, most distinctive first.
+
+    Each word is represented by a dictionary with the keys `word` and
+    `count`; distinctive words also have a `score`, the log ratio of the
+    word's frequency for the character to its frequency in the corpus.
+
+    The `limit` query parameter sets how many words each list contains.
+    """
+    index = words.get_index()
+    summary = index.summary(index.characters, id, limit)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="character not found or character has no lines.")
+    return {"character_id": id, **summary}
 
 
 @router.get("/characters/{id}", tags=["characters"])
+@cache.cached()
 def get_character(id: int):
     """
     This endpoint returns a single character by its identifier. For each character
@@ -63,29 +259,12 @@ def get_character(id: int):
       originally queried character.
     """
 
-    character_info = sqlalchemy.select(
-        db.characters.c.name,
-        db.characters.c.movie_id,
-        db.characters.c.gender,
-    ).where(db.characters.c.character_id == id)
-
-    with db.engine.connect() as conn:
-        character_info = conn.execute(character_info).fetchone()
-        if not character_info:
+    with db.read_engine().connect() as conn:
+        characters = get_characters_by_ids([id], conn)
+        if id not in characters:
             raise HTTPException(status_code=404, detail="character not found.")
-        movie_id = character_info.movie_id
-        movie = conn.execute(sqlalchemy.select(
-            db.movies.c.title
-        ).where(db.movies.c.movie_id == movie_id)).fetchone().title
-        top_conversation_info = get_top_conv_characters(id, conn)
-        json = {
-            "character_id": id,
-            "character": character_info.name,
-            "movie": movie,
-            "gender": character_info.gender,
-            "top_conversations": top_conversation_info
-        }
-    return json
+        json = characters[id]
+    return json_response(json)
 
 
 class character_sort_options(str, Enum):
@@ -94,12 +273,32 @@ class character_sort_options(str, Enum):
     number_of_lines = "number_of_lines"
 
 
+class character_gender_options(str, Enum):
+    male = "male"
+    female = "female"
+    unknown = "unknown"
+
+
+# Spellings of each gender in the `characters` table. Filtering with a list
+# of values instead of a function of the column keeps its index usable.
+GENDER_VALUES = {
+    character_gender_options.male: ["m", "M"],
+    character_gender_options.female: ["f", "F"],
+}
+
+
 @router.get("/characters/", tags=["characters"])
+@cache.cached(
+    key=lambda name, limit, offset, min_lines, gender, sort, format: (
+        name.lower(), limit, offset, min_lines, gender and gender.value, sort.value, format.value))
 def list_characters(
     name: str = "",
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
+    min_lines: int = Query(0, ge=0),
+    gender: Optional[character_gender_options] = None,
     sort: character_sort_options = character_sort_options.character,
+    format: response_formats = response_formats.rows,
 ):
     """
     This endpoint returns a list of characters. For each character it returns:
@@ -110,7 +309,9 @@ def list_characters(
     * `number_of_lines`: The number of lines the character has in the movie.
 
     You can filter for characters whose name contains a string by using the
-    `name` query parameter.
+    `name` query parameter, and combine it with:
+    * `min_lines` - Characters with at least the given number of lines.
+    * `gender` - `male`, `female` or `unknown`.
 
     You can also sort the results by using the `sort` query parameter:
     * `character` - Sort by character name alphabetically.
@@ -121,18 +322,22 @@ def list_characters(
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
+
+    With `format=columnar` the result is a single object that maps each of
+    the keys above to the list of its values, in the same order.
     """
 
+    # Characters without stats have no lines, so with `min_lines` set the
+    # raw column can be sorted on, which its index provides.
+    if min_lines > 0:
+        num_lines = db.character_stats.c.num_lines
+    else:
+        num_lines = sqlalchemy.func.coalesce(db.character_stats.c.num_lines, 0)
     if sort is character_sort_options.character:
         order_by = db.characters.c.name
     elif sort is character_sort_options.movie:
         order_by = db.movies.c.title
     elif sort is character_sort_options.number_of_lines:
-        whens = [
-            (db.characters.c.character_id == id_, num_lines)
-            for id_, num_lines in db.chars_to_num_lines.items()
-        ]
-        num_lines = sqlalchemy.case(*whens, else_=0).label('num_lines')
         order_by = sqlalchemy.desc(num_lines)
     else:
         assert False
@@ -141,12 +346,16 @@ def list_characters(
         sqlalchemy.select(
             db.characters.c.character_id,
             db.characters.c.name,
-            db.characters.c.movie_id,
+            db.movies.c.title,
+            db.character_stats.c.num_lines,
         )
             .select_from(
             db.characters.join(
                 db.movies,
                 db.characters.c.movie_id == db.movies.c.movie_id
+            ).outerjoin(
+                db.character_stats,
+                db.characters.c.character_id == db.character_stats.c.character_id
             ))
             .limit(limit)
             .offset(offset)
@@ -156,26 +365,19 @@ def list_characters(
     # filter only if name parameter is passed
     if name != "":
         stmt = stmt.where(db.characters.c.name.ilike(f"%{name}%"))
+    if min_lines > 0:
+        stmt = stmt.where(db.character_stats.c.num_lines >= min_lines)
+    if gender is character_gender_options.unknown:
+        known = [value for values in GENDER_VALUES.values() for value in values]
+        stmt = stmt.where(sqlalchemy.or_(
+            db.characters.c.gender.is_(None),
+            db.characters.c.gender.not_in(known)))
+    elif gender is not None:
+        stmt = stmt.where(db.characters.c.gender.in_(GENDER_VALUES[gender]))
 
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        json = []
-        for row in result:
-            movie = conn.execute(
-                sqlalchemy.select(
-                    db.movies.c.title
-                ).where(db.movies.c.movie_id == row.movie_id)
-            ).fetchone()
-
-            json.append(
-                {
-                    "character_id": row.character_id,
-                    "character": row.name,
-                    "movie": movie.title,
-                    "number_of_lines": db.chars_to_num_lines.get(row.character_id)
-                }
-            )
+    with db.read_engine().connect() as conn:
+        rows = conn.execute(stmt).fetchall()
 
-    return json
+    return table_response(["character_id", "character", "movie", "number_of_lines"], rows, format)
 
 # print(list_characters(name="amy", limit=6, offset=0, sort=character_sort_options.number_of_lines))
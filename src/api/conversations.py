@@ -1,8 +1,21 @@
 from fastapi import APIRouter, HTTPException
+from src import admission
+from src import autocomplete
+from src import cache
 from src import database as db
+from src import dialogue_stats
+from src import graph
+from src import inverted_index
+from src import schema
+from src import words
+from src.group_commit import GroupCommitter
 from pydantic import BaseModel
 from typing import List
 import sqlalchemy
+import logging
+import os
+
+logger = logging.getLogger(__name__)
 
 
 # FastAPI is inferring what the request body should look like
@@ -18,26 +31,10 @@ class ConversationJson(BaseModel):
     lines: List[LinesJson]
 
 
-router = APIRouter()
-
-
-@router.post("/movies/{movie_id}/conversations/", tags=["movies"])
-def add_conversation(movie_id: int, conversation: ConversationJson):
-    """
-    This endpoint adds a conversation to a movie. The conversation is represented
-    by the two characters involved in the conversation and a series of lines between
-    those characters in the movie.
-
-    The endpoint ensures that all characters are part of the referenced movie,
-    that the characters are not the same, and that the lines of a conversation
-    match the characters involved in the conversation.
-
-    Line sort is set based on the order in which the lines are provided in the
-    request body.
+router = APIRouter(dependencies=[admission.limit("write")])
 
-    The endpoint returns the id of the resulting conversation that was created.
-    """
 
+def validate_conversation(conn, movie_id, conversation):
     c1_id = conversation.character_1_id
     c2_id = conversation.character_2_id
 
@@ -48,59 +45,68 @@ def add_conversation(movie_id: int, conversation: ConversationJson):
         db.characters.c.movie_id
     ).where((db.characters.c.character_id == c1_id) | (db.characters.c.character_id == c2_id))
 
-    with db.engine.connect() as conn:
-        result = [row.movie_id for row in conn.execute(stmt).fetchall()]
+    result = [row.movie_id for row in conn.execute(stmt).fetchall()]
 
-        if len(result) < 2:
-            raise HTTPException(status_code=404, detail="character(s) not found.")
+    if len(result) < 2:
+        raise HTTPException(status_code=404, detail="character(s) not found.")
 
-        if result[0] != result[1]:
-            raise HTTPException(status_code=400, detail="characters are not from the same movie.")
+    if result[0] != result[1]:
+        raise HTTPException(status_code=400, detail="characters are not from the same movie.")
 
-        if result[0] != movie_id:
-            raise HTTPException(status_code=400, detail="character(s) are not from the movie provided in movie_id.")
+    if result[0] != movie_id:
+        raise HTTPException(status_code=400, detail="character(s) are not from the movie provided in movie_id.")
 
-        conv_id = conn.execute(
-            sqlalchemy.select(
-                db.conversations.c.conversation_id
-            )
-            .order_by(sqlalchemy.desc(db.conversations.c.conversation_id))
-            .limit(1)
-        ).fetchone().conversation_id + 1
 
-        conv_to_upload = {
+def write_conversations(conn, batch):
+    """
+    Inserts every `(movie_id, conversation)` pair of `batch` using `conn`,
+    without committing. Returns a list with, for each conversation, a dict
+    describing what was written.
+    """
+    schema.lock_writes(conn)
+    conv_id = conn.execute(
+        sqlalchemy.select(
+            db.conversations.c.conversation_id
+        )
+        .order_by(sqlalchemy.desc(db.conversations.c.conversation_id))
+        .limit(1)
+    ).fetchone().conversation_id + 1
+
+    current_line_id = conn.execute(
+        sqlalchemy.select(
+            db.lines.c.line_id
+        )
+        .order_by(sqlalchemy.desc(db.lines.c.line_id))
+        .limit(1)
+    ).fetchone().line_id + 1
+
+    convs_to_upload = []
+    lines_to_upload = []
+    written = []
+    for movie_id, conversation in batch:
+        c1_id = conversation.character_1_id
+        c2_id = conversation.character_2_id
+
+        convs_to_upload.append({
             "conversation_id": conv_id,
             "character1_id": c1_id,
             "character2_id": c2_id,
             "movie_id": movie_id
-        }
-
-        conn.execute(db.conversations.insert().values(**conv_to_upload))
-        print(conv_to_upload)
-
-        current_line_id = conn.execute(
-            sqlalchemy.select(
-                db.lines.c.line_id
-            )
-            .order_by(sqlalchemy.desc(db.lines.c.line_id))
-            .limit(1)
-        ).fetchone().line_id + 1
+        })
 
         current_line_sort = 1
-        lines = conversation.lines
-
         c1_lines = 0
         c2_lines = 0
-        for line in lines:
-            line_to_upload = {
+        conv_lines = []
+        for line in conversation.lines:
+            conv_lines.append({
                 "line_id": current_line_id,
                 "character_id": line.character_id,
                 "movie_id": movie_id,
                 "conversation_id": conv_id,
                 "line_sort": current_line_sort,
                 "line_text": line.line_text
-            }
-            conn.execute(db.lines.insert().values(**line_to_upload))
+            })
             current_line_id += 1
             current_line_sort += 1
 
@@ -109,13 +115,98 @@ def add_conversation(movie_id: int, conversation: ConversationJson):
             elif line.character_id == c2_id:
                 c2_lines += 1
 
-        db.chars_to_num_lines[c1_id] += c1_lines
-        db.chars_to_num_lines[c2_id] += c2_lines
-        db.conv_to_num_lines[conv_id] = c1_lines + c2_lines
+        written.append({
+            "conversation_id": conv_id,
+            "movie_id": movie_id,
+            "lines_by_character": {c1_id: c1_lines, c2_id: c2_lines},
+        })
+        lines_to_upload.extend(conv_lines)
+        conv_id += 1
+
+    conn.execute(db.conversations.insert(), convs_to_upload)
+    if lines_to_upload:
+        conn.execute(db.lines.insert(), lines_to_upload)
+
+    for conv in written:
+        schema.record_conversation(conn, db.metadata_obj, conv["conversation_id"], conv["lines_by_character"])
+    schema.record_transcripts(conn, db.metadata_obj, [conv["conversation_id"] for conv in written])
+    schema.record_changes(conn, db.metadata_obj, written)
+
+    return written
+
+
+def update_caches(written):
+    """
+    Brings this process's in-memory indexes up to date with committed
+    conversations and drops the cached responses. The line counts are
+    already in the summary tables, written with the conversations.
+    """
+    if written:
+        graph.sync()
+        words.sync()
+        inverted_index.sync()
+        dialogue_stats.sync()
+        autocomplete.sync()
+        cache.invalidate()
+
+
+def write_batch(batch):
+    """Writes posts in one transaction and returns them as written."""
+    with db.engine.begin() as conn:
+        return write_conversations(conn, batch)
+
+
+def after_commit(written):
+    """
+    Runs `update_caches` for committed conversations. They are saved
+    whatever happens here, so errors are logged instead of failing the
+    posts or, under group commit, writing them again.
+    """
+    try:
+        update_caches(written)
+    except Exception:
+        logger.exception("updating caches after a commit failed")
+
+
+# With CONVERSATION_GROUP_COMMIT set, validated posts are queued and
+# written by a background worker in batched transactions.
+if os.environ.get("CONVERSATION_GROUP_COMMIT"):
+    writer = GroupCommitter(
+        write_batch,
+        after_commit=after_commit,
+        max_batch=int(os.environ.get("CONVERSATION_GROUP_COMMIT_MAX_BATCH", "100")),
+        max_delay=float(os.environ.get("CONVERSATION_GROUP_COMMIT_MAX_DELAY", "0.005")),
+    )
+else:
+    writer = None
+
+
+@router.post("/movies/{movie_id}/conversations/", tags=["movies"])
+def add_conversation(movie_id: int, conversation: ConversationJson):
+    """
+    This endpoint adds a conversation to a movie. The conversation is represented
+    by the two characters involved in the conversation and a series of lines between
+    those characters in the movie.
+
+    The endpoint ensures that all characters are part of the referenced movie,
+    that the characters are not the same, and that the lines of a conversation
+    match the characters involved in the conversation.
+
+    Line sort is set based on the order in which the lines are provided in the
+    request body.
+
+    The endpoint returns the id of the resulting conversation that was created.
+    """
+
+    with db.engine.connect() as conn:
+        validate_conversation(conn, movie_id, conversation)
 
-        conn.commit()
+    if writer is not None:
+        return writer.submit((movie_id, conversation))["conversation_id"]
 
-    return conv_id
+    written = write_batch([(movie_id, conversation)])
+    after_commit(written)
+    return written[0]["conversation_id"]
 
 
 # conversation = ConversationJson(
@@ -0,0 +1,164 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from enum import Enum
+from typing import Optional
+
+from src import admission
+from src import database as db
+import sqlalchemy
+
+import csv
+import io
+import json
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # Arrow and Parquet exports are only offered with pyarrow installed.
+    pyarrow = None
+
+router = APIRouter(dependencies=[admission.limit("export")])
+
+# Rows fetched from the server-side cursor and written out at a time.
+CHUNK_SIZE = 5000
+
+
+class export_tables(str, Enum):
+    movies = "movies"
+    characters = "characters"
+    conversations = "conversations"
+    lines = "lines"
+
+
+class export_formats(str, Enum):
+    csv = "csv"
+    ndjson = "ndjson"
+    arrow = "arrow"
+    parquet = "parquet"
+
+
+media_types = {
+    export_formats.csv: "text/csv",
+    export_formats.ndjson: "application/x-ndjson",
+    export_formats.arrow: "application/vnd.apache.arrow.stream",
+    export_formats.parquet: "application/vnd.apache.parquet",
+}
+
+
+def stream_rows(table, movie_id):
+    """
+    Yields the rows of `table` in chunks of `CHUNK_SIZE`, read through a
+    server-side cursor so memory use does not depend on the table size.
+    """
+    stmt = sqlalchemy.select(table).order_by(*table.primary_key.columns)
+    if movie_id is not None:
+        stmt = stmt.where(table.c.movie_id == movie_id)
+
+    with db.read_engine().connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=CHUNK_SIZE).execute(stmt)
+        for chunk in result.partitions():
+            yield chunk
+
+
+def to_csv(table, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(table.columns.keys())
+    for chunk in chunks:
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def to_ndjson(table, chunks):
+    columns = table.columns.keys()
+    for chunk in chunks:
+        yield "".join(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in chunk)
+
+
+def arrow_schema(table):
+    def arrow_type(column):
+        if isinstance(column.type, sqlalchemy.Integer):
+            return pyarrow.int64()
+        if isinstance(column.type, (sqlalchemy.Float, sqlalchemy.Numeric)):
+            return pyarrow.float64()
+        return pyarrow.string()
+
+    return pyarrow.schema([(column.name, arrow_type(column)) for column in table.columns])
+
+
+def coerce(values, arrow_type):
+    # NUMERIC columns come back as Decimal and other types (e.g. dates) as
+    # Python objects, which Arrow will not convert implicitly.
+    if arrow_type == pyarrow.float64():
+        return [None if value is None else float(value) for value in values]
+    if arrow_type == pyarrow.string():
+        return [None if value is None else str(value) for value in values]
+    return values
+
+
+def to_arrow(table, chunks, writer_class):
+    schema = arrow_schema(table)
+    sink = io.BytesIO()
+    writer = writer_class(sink, schema)
+    for chunk in chunks:
+        columns = list(zip(*chunk))
+        batch = pyarrow.record_batch(
+            [pyarrow.array(coerce(values, field.type), type=field.type) for values, field in zip(columns, schema)],
+            schema=schema,
+        )
+        writer.write_batch(batch)
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+
+@router.get("/export/{table}", tags=["export"])
+def export_table(
+    table: export_tables,
+    format: export_formats = export_formats.csv,
+    movie_id: Optional[int] = None,
+):
+    """
+    This endpoint streams a complete table (`movies`, `characters`,
+    `conversations` or `lines`) in one response, ordered by its primary key.
+    It is meant for analytics jobs that need the whole corpus, instead of
+    paging through the list endpoints.
+
+    The `format` query parameter selects the encoding:
+    * `csv` - Comma separated values with a header row.
+    * `ndjson` - One JSON object per line.
+    * `arrow` - An Apache Arrow IPC stream.
+    * `parquet` - An Apache Parquet file.
+
+    The `arrow` and `parquet` formats require `pyarrow` to be installed on
+    the server.
+
+    The `movie_id` query parameter limits the export to a single movie.
+    """
+    sql_table = db.metadata_obj.tables[table.value]
+    chunks = stream_rows(sql_table, movie_id)
+
+    if format is export_formats.csv:
+        body = to_csv(sql_table, chunks)
+    elif format is export_formats.ndjson:
+        body = to_ndjson(sql_table, chunks)
+    elif pyarrow is None:
+        raise HTTPException(status_code=501, detail="arrow and parquet exports are not available.")
+    elif format is export_formats.arrow:
+        body = to_arrow(sql_table, chunks, pyarrow.ipc.new_stream)
+    elif format is export_formats.parquet:
+        body = to_arrow(sql_table, chunks, pyarrow.parquet.ParquetWriter)
+    else:
+        assert False
+
+    return StreamingResponse(
+        body,
+        media_type=media_types[format],
+        headers={"Content-Disposition": f"attachment; filename={table.value}.{format.value}"},
+    )
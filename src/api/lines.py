@@ -5,16 +5,20 @@ from fastapi.params import Query
 
 from enum import Enum
 
+from src import admission
+from src import cache
 from src import database as db
+from src.api.responses import json_response, response_formats, table_response
 import sqlalchemy
 
 from collections import OrderedDict
 
-router = APIRouter()
+router = APIRouter(dependencies=[admission.limit("expensive")])
 
 
 @router.get("/lines/{id}", tags=["lines"])
-def get_character_lines(id: int):
+@cache.cached()
+def get_character_lines(id: int, format: response_formats = response_formats.rows):
     """
     This endpoint returns a list of lines spoken by the character
     whose id is given.
@@ -28,6 +32,9 @@ def get_character_lines(id: int):
     * `line_text`: the text of the line
 
     The lines will be sorted by `line_id`.
+
+    With `format=columnar` the result is a single object that maps each of
+    the keys above to the list of its values, in the same order.
     """
 
     stmt = sqlalchemy.select(
@@ -38,7 +45,7 @@ def get_character_lines(id: int):
         db.lines.c.line_text
     ).where(db.lines.c.character_id == id).order_by(db.lines.c.line_id)
 
-    with db.engine.connect() as conn:
+    with db.read_engine().connect() as conn:
         line_info = conn.execute(stmt).fetchall()
         print(line_info)
         if len(line_info) == 0:
@@ -47,7 +54,7 @@ def get_character_lines(id: int):
             db.movies.c.title
         ).where(db.movies.c.movie_id == line_info[0].movie_id)).fetchone()
 
-        json = []
+        rows = []
         for line in line_info:
             said_to = conn.execute(sqlalchemy.select(
                 db.conversations.c.character1_id,
@@ -60,17 +67,15 @@ def get_character_lines(id: int):
                 db.characters.c.name
             ).where(db.characters.c.character_id == said_to_id)).fetchone()
 
-            json.append(
-                {
-                    "line_id": line.line_id,
-                    "conv_id": line.conversation_id,
-                    "line_sort": line.line_sort,
-                    "said_to": said_to_name.name,
-                    "movie": movie.title,
-                    "line_text": line.line_text
-                }
-            )
-    return json
+            rows.append((
+                line.line_id,
+                line.conversation_id,
+                line.line_sort,
+                said_to_name.name,
+                movie.title,
+                line.line_text
+            ))
+    return table_response(["line_id", "conv_id", "line_sort", "said_to", "movie", "line_text"], rows, format)
 
 
 class line_sort_options(str, Enum):
@@ -80,6 +85,7 @@ class line_sort_options(str, Enum):
 
 
 @router.get("/lines/", tags=["lines"])
+@cache.cached(key=lambda token, limit, sort: (token.lower(), limit, sort.value))
 def list_characters_lines(
         token: str,
         limit: int = Query(50, ge=1, le=250),
@@ -140,7 +146,7 @@ def list_characters_lines(
     if sort != line_sort_options.lines_with_token:
         stmt = stmt.order_by(order_by).limit(limit)
 
-    with db.engine.connect() as conn:
+    with db.read_engine().connect() as conn:
         result = conn.execute(stmt)
 
         json = [
@@ -154,9 +160,9 @@ def list_characters_lines(
 
     if sort == line_sort_options.lines_with_token:
         json.sort(key=lambda x: (-len(x["lines_with_token"]), x["c_id"]))
-        return json[:limit]
+        return json_response(json[:limit])
 
-    return json
+    return json_response(json)
 
 
 class lines_spoken_to_sort_options(str, Enum):
@@ -165,6 +171,7 @@ class lines_spoken_to_sort_options(str, Enum):
 
 
 @router.get("/lines_spoken_to/", tags=["lines"])
+@cache.cached()
 def get_lines_spoken_to(
         id: int,
         sort: lines_spoken_to_sort_options = lines_spoken_to_sort_options.name):
@@ -199,7 +206,7 @@ def get_lines_spoken_to(
         db.characters.c.character_id.in_([db.conversations.c.character1_id, db.conversations.c.character2_id])
     )
 
-    with db.engine.connect() as conn:
+    with db.read_engine().connect() as conn:
         result = conn.execute(stmt).fetchall()
         json = OrderedDict()
         for line in result:
@@ -215,4 +222,4 @@ def get_lines_spoken_to(
     elif sort == lines_spoken_to_sort_options.number_of_lines:
         out.sort(key=lambda x: -len(list(x.values())[0]))
 
-    return out
+    return json_response(out)
@@ -1,13 +1,110 @@
 from fastapi import APIRouter, HTTPException
 from enum import Enum
+from typing import List, Optional
+from src import admission
+from src import cache
+from src import autocomplete
 from src import database as db
+from src import dialogue_stats
+from src import words
+from src.api.responses import json_response, response_formats, table_response
 from fastapi.params import Query
 import sqlalchemy
 
-router = APIRouter()
+router = APIRouter(dependencies=[admission.limit("cheap")])
+
+
+def get_movies_by_ids(movie_ids, conn):
+    """
+    Builds the `get_movie` payload for every id in `movie_ids` using two
+    queries, no matter how many movies are requested. Returns a dict keyed
+    by movie id; ids that do not exist are left out.
+    """
+    movie_ids = list(set(movie_ids))
+    if len(movie_ids) == 0:
+        return {}
+
+    movie_info = sqlalchemy.select(
+        db.movies.c.movie_id,
+        db.movies.c.title
+    ).where(db.movies.c.movie_id.in_(movie_ids))
+
+    num_lines = sqlalchemy.func.coalesce(db.character_stats.c.num_lines, 0).label("num_lines")
+    rank = sqlalchemy.func.row_number().over(
+        partition_by=db.characters.c.movie_id,
+        order_by=(sqlalchemy.desc(num_lines), db.characters.c.character_id)
+    ).label("rank")
+    ranked = sqlalchemy.select(
+        db.characters.c.movie_id,
+        db.characters.c.character_id,
+        db.characters.c.name,
+        num_lines,
+        rank,
+    ).select_from(
+        db.characters.outerjoin(
+            db.character_stats,
+            db.characters.c.character_id == db.character_stats.c.character_id
+        )
+    ).where(db.characters.c.movie_id.in_(movie_ids)).subquery()
+    character_info = sqlalchemy.select(ranked)\
+        .where(ranked.c.rank <= 5)\
+        .order_by(ranked.c.movie_id, ranked.c.rank)
+
+    json = {}
+    for row in conn.execute(movie_info):
+        json[row.movie_id] = {
+            "movie_id": row.movie_id,
+            "title": row.title,
+            "top_characters": []
+        }
+    for row in conn.execute(character_info):
+        json[row.movie_id]["top_characters"].append(
+            {"character_id": row.character_id,
+             "character": row.name,
+             "num_lines": row.num_lines})
+    return json
+
+
+@router.get("/movies/batch", tags=["movies"])
+@cache.cached()
+def get_movies(ids: List[int] = Query(..., max_items=250)):
+    """
+    This endpoint returns several movies at once. Pass each movie id as a
+    repeated `ids` query parameter, e.g. `/movies/batch?ids=44&ids=436`.
+
+    Each movie has exactly the same shape as the response of
+    `/movies/{movie_id}`. Movies are returned in the order their ids were
+    given; ids that do not match a movie are skipped.
+    """
+    with db.read_engine().connect() as conn:
+        movies = get_movies_by_ids(ids, conn)
+
+    return json_response([movies[movie_id] for movie_id in dict.fromkeys(ids) if movie_id in movies])
+
+
+@router.get("/movies/autocomplete", tags=["movies"])
+def autocomplete_movies(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(10, ge=1, le=50),
+):
+    """
+    This endpoint suggests movies for a search box. It returns the movies
+    with a word in their title that starts with `q` (ignoring case, accents
+    and punctuation), those with the most IMDB votes first.
+
+    For each movie it returns:
+    * `movie_id`: the internal id of the movie.
+    * `movie_title`: The title of the movie.
+    * `year`: The year the movie was released.
+    * `imdb_votes`: The number of IMDB votes for the movie.
+
+    The `limit` query parameter sets the maximum number of suggestions.
+    """
+    return autocomplete.get_index().complete_movies(q, limit)
 
 
 @router.get("/movies/{movie_id}", tags=["movies"])
+@cache.cached()
 def get_movie(movie_id: int):
     """
     This endpoint returns a single movie by its identifier. For each movie it returns:
@@ -23,51 +120,134 @@ def get_movie(movie_id: int):
     * `num_lines`: The number of lines the character has in the movie.
 
     """
-    movie_info = sqlalchemy.select(
-        db.movies.c.title
-    ).where(db.movies.c.movie_id == movie_id)
-    character_info = sqlalchemy.select(
-        db.characters.c.character_id,
-        db.characters.c.name,
-        db.characters.c.num_lines,
-    ).select_from(db.movies.join(db.characters)).where(db.movies.c.movie_id == movie_id)\
-        .limit(5)\
-        .order_by(sqlalchemy.desc(db.characters.c.num_lines), db.characters.c.character_id)
-
-    with db.engine.connect() as conn:
-        movie_info = conn.execute(movie_info).fetchone()
-        if not movie_info:
+    with db.read_engine().connect() as conn:
+        movies = get_movies_by_ids([movie_id], conn)
+        if movie_id not in movies:
             raise HTTPException(status_code=404, detail="movie not found.")
-        character_info = conn.execute(character_info)
+        json = movies[movie_id]
+    return json_response(json)
 
-        top_characters = [
-            {"character_id": row.character_id,
-             "character": row.name,
-             "num_lines": row.num_lines}
-            for row in character_info]
+# print(get_movie(0))
 
-        json = {
-            "movie_id": movie_id,
-            "title": movie_info.title,
-            "top_characters": top_characters
-        }
-    return json
 
-# print(get_movie(0))
+@router.get("/movies/{movie_id}/words", tags=["movies"])
+def get_movie_words(movie_id: int, limit: int = Query(25, ge=1, le=250)):
+    """
+    This endpoint returns vocabulary statistics for the dialogue of a movie:
+    * `movie_id`: the internal id of the movie.
+    * `total_words`: The number of words spoken in the movie.
+    * `unique_words`: The number of distinct words spoken in the movie.
+    * `top_words`: The most frequent words, highest count first.
+    * `distinctive_words`: The words most over-represented in this movie
+      compared to the whole corpus, most distinctive first.
+
+    Each word is represented by a dictionary with the keys `word` and
+    `count`; distinctive words also have a `score`, the log ratio of the
+    word's frequency in the movie to its frequency in the corpus.
+
+    The `limit` query parameter sets how many words each list contains.
+    """
+    index = words.get_index()
+    summary = index.summary(index.movies, movie_id, limit)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="movie not found or movie has no lines.")
+    return {"movie_id": movie_id, **summary}
+
+
+@router.get("/movies/{movie_id}/stats", tags=["movies"])
+def get_movie_stats(movie_id: int):
+    """
+    This endpoint returns dialogue statistics for a movie:
+    * `movie_id`: the internal id of the movie.
+    * `title`: The title of the movie.
+    * `num_lines`: The number of lines in the movie.
+    * `num_words`: The number of words spoken in the movie.
+    * `num_characters`: The number of characters who speak in the movie.
+    * `num_conversations`: The number of conversations in the movie.
+    * `lines_per_character`: The `mean`, `median` and `max` number of lines
+      spoken by a character.
+    * `words_per_character`: The `mean`, `median` and `max` number of words
+      spoken by a character.
+    * `gender_split`: The share of lines spoken by `male`, `female` and
+      `unknown` characters.
+    * `conversation_length`: The `mean`, `median`, `p90` and `max` number of
+      lines in a conversation, and a `histogram` of conversation lengths.
+      Each bucket has a `min` and `max` length (`max` is null for the last
+      bucket) and the `count` of conversations.
+    * `top5_share`: The share of lines spoken by the five characters with
+      the most lines.
+    """
+    stats = dialogue_stats.get_stats().movie(movie_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="movie not found.")
+    return stats
+
+
+class movie_stats_sort_options(str, Enum):
+    num_lines = "num_lines"
+    num_words = "num_words"
+    lines_per_character = "lines_per_character"
+    words_per_character = "words_per_character"
+    female_share = "female_share"
+    conversation_length = "conversation_length"
+    top5_share = "top5_share"
+
+
+movie_stats_sort_columns = {
+    movie_stats_sort_options.num_lines: "num_lines",
+    movie_stats_sort_options.num_words: "num_words",
+    movie_stats_sort_options.lines_per_character: "lines_per_character_mean",
+    movie_stats_sort_options.words_per_character: "words_per_character_mean",
+    movie_stats_sort_options.female_share: "female_share",
+    movie_stats_sort_options.conversation_length: "conversation_length_mean",
+    movie_stats_sort_options.top5_share: "top5_share",
+}
+
+
+@router.get("/stats/movies", tags=["movies"])
+def list_movie_stats(
+    limit: int = Query(50, ge=1, le=250),
+    offset: int = Query(0, ge=0),
+    sort: movie_stats_sort_options = movie_stats_sort_options.num_lines,
+):
+    """
+    This endpoint ranks every movie by a dialogue statistic. Each movie has
+    exactly the same shape as the response of `/movies/{movie_id}/stats`.
+
+    You can choose the ranking with the `sort` query parameter; every
+    ranking is highest to lowest:
+    * `num_lines` - Number of lines.
+    * `num_words` - Number of words.
+    * `lines_per_character` - Mean lines per speaking character.
+    * `words_per_character` - Mean words per speaking character.
+    * `female_share` - Share of lines spoken by female characters.
+    * `conversation_length` - Mean lines per conversation.
+    * `top5_share` - Share of lines spoken by the top five characters.
+
+    The `limit` and `offset` query parameters are used for pagination.
+    """
+    return dialogue_stats.get_stats().ranking(movie_stats_sort_columns[sort], limit, offset)
 
 
 class movie_sort_options(str, Enum):
     movie_title = "movie_title"
     year = "year"
     rating = "rating"
+    votes = "votes"
 
 
 @router.get("/movies/", tags=["movies"])
+@cache.cached()
 def list_movies(
     name: str = "",
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
-    sort: movie_sort_options = movie_sort_options.movie_title,
+    year_min: Optional[int] = None,
+    year_max: Optional[int] = None,
+    rating_min: Optional[float] = None,
+    votes_min: Optional[int] = None,
+    sort: List[movie_sort_options] = Query([movie_sort_options.movie_title], max_items=3),
+    format: response_formats = response_formats.rows,
 ):
     """
     This endpoint returns a list of movies. For each movie it returns:
@@ -79,26 +259,40 @@ def list_movies(
     * `imdb_votes`: The number of IMDB votes for the movie.
 
     You can filter for movies whose titles contain a string by using the
-    `name` query parameter.
+    `name` query parameter, and combine it with the range filters:
+    * `year_min` / `year_max` - Released in or after / in or before a year.
+    * `rating_min` - IMDB rating of at least the given value.
+    * `votes_min` - At least the given number of IMDB votes.
 
     You can also sort the results by using the `sort` query parameter:
     * `movie_title` - Sort by movie title alphabetically.
     * `year` - Sort by year of release, earliest to latest.
     * `rating` - Sort by rating, highest to lowest.
+    * `votes` - Sort by number of IMDB votes, highest to lowest.
+
+    Repeat `sort` (up to three times) to break ties, e.g.
+    `sort=year&sort=rating` lists each year's movies best rated first.
 
     The `limit` and `offset` query
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
+
+    With `format=columnar` the result is a single object that maps each of
+    the keys above to the list of its values, in the same order.
     """
-    if sort is movie_sort_options.movie_title:
-        order_by = db.movies.c.title
-    elif sort is movie_sort_options.year:
-        order_by = db.movies.c.year
-    elif sort is movie_sort_options.rating:
-        order_by = sqlalchemy.desc(db.movies.c.imdb_rating)
-    else:
-        assert False
+    order_by = []
+    for option in dict.fromkeys(sort):
+        if option is movie_sort_options.movie_title:
+            order_by.append(db.movies.c.title)
+        elif option is movie_sort_options.year:
+            order_by.append(db.movies.c.year)
+        elif option is movie_sort_options.rating:
+            order_by.append(sqlalchemy.desc(db.movies.c.imdb_rating))
+        elif option is movie_sort_options.votes:
+            order_by.append(sqlalchemy.desc(db.movies.c.imdb_votes))
+        else:
+            assert False
 
     stmt = (
         sqlalchemy.select(
@@ -110,28 +304,29 @@ def list_movies(
         )
             .limit(limit)
             .offset(offset)
-            .order_by(order_by, db.movies.c.movie_id)
+            .order_by(*order_by, db.movies.c.movie_id)
     )
 
     # filter only if name parameter is passed
     if name != "":
         stmt = stmt.where(db.movies.c.title.ilike(f"%{name}%"))
+    # The bounds are cast to the column type so they compare the same way
+    # whether `year` is stored as text or as a number, and can use its index.
+    # `year_max` is checked as "before the next year" so text years with a
+    # suffix ("1998/I") still count as 1998.
+    if year_min is not None:
+        stmt = stmt.where(db.movies.c.year >= sqlalchemy.cast(str(year_min), db.movies.c.year.type))
+    if year_max is not None:
+        stmt = stmt.where(db.movies.c.year < sqlalchemy.cast(str(year_max + 1), db.movies.c.year.type))
+    if rating_min is not None:
+        stmt = stmt.where(db.movies.c.imdb_rating >= rating_min)
+    if votes_min is not None:
+        stmt = stmt.where(db.movies.c.imdb_votes >= votes_min)
 
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        json = []
-        for row in result:
-            json.append(
-                {
-                    "movie_id": row.movie_id,
-                    "movie_title": row.title,
-                    "year": row.year,
-                    "imdb_rating": row.imdb_rating,
-                    "imdb_votes": row.imdb_votes,
-                }
-            )
+    with db.read_engine().connect() as conn:
+        rows = conn.execute(stmt).fetchall()
 
-    return json
+    return table_response(["movie_id", "movie_title", "year", "imdb_rating", "imdb_votes"], rows, format)
 
 
 # print(list_movies("", limit=50, offset=0, sort=movie_sort_options.movie_title))
@@ -0,0 +1,42 @@
+from decimal import Decimal
+from enum import Enum
+
+import orjson
+from fastapi.responses import Response
+
+
+class response_formats(str, Enum):
+    rows = "rows"
+    columnar = "columnar"
+
+
+def _default(value):
+    # NUMERIC columns come back as Decimal, which orjson does not encode.
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError
+
+
+def json_response(content, status_code=200):
+    """
+    Encodes `content` with orjson and returns it as a finished response,
+    so FastAPI does not walk it with `jsonable_encoder` and `json` again.
+    """
+    return Response(
+        orjson.dumps(content, default=_default, option=orjson.OPT_SERIALIZE_NUMPY),
+        status_code=status_code,
+        media_type="application/json",
+    )
+
+
+def table_response(names, rows, format=response_formats.rows):
+    """
+    Returns `rows` (sequences of values in the order of `names`) as JSON.
+    With the `rows` format that is a list with one object per row; with the
+    `columnar` format it is one object mapping each name to the list of its
+    values, built without a dict per row.
+    """
+    if format is response_formats.columnar:
+        columns = list(zip(*rows)) or [()] * len(names)
+        return json_response(dict(zip(names, columns)))
+    return json_response([dict(zip(names, row)) for row in rows])
@@ -0,0 +1,60 @@
+from fastapi import APIRouter
+from fastapi.params import Query
+from typing import Optional
+
+from src import admission
+from src import inverted_index
+
+router = APIRouter(dependencies=[admission.limit("cheap")])
+
+
+@router.get("/search/lines", tags=["lines"])
+def search_lines(
+    q: str = Query(..., min_length=1, max_length=200),
+    movie_id: Optional[int] = None,
+    character_id: Optional[int] = None,
+    year_min: Optional[int] = None,
+    year_max: Optional[int] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+):
+    """
+    This endpoint searches the text of every line and returns the best
+    matching lines, ranked by BM25 relevance.
+
+    The query `q` can contain several words, which are all optional but
+    raise the score of lines that contain them, and phrases in double
+    quotes, e.g. `q="i love you" forever`, which a line must contain word
+    for word.
+
+    The results can be narrowed with the `movie_id`, `character_id`,
+    `year_min` and `year_max` query parameters.
+
+    It returns:
+    * `total`: the number of lines that match. For phrase queries this is
+      the number of lines containing every word of the phrases.
+    * `results`: the requested page of lines, best match first.
+
+    For each line it returns:
+    * `line_id`: the internal id of the line.
+    * `conv_id`: the id of the conversation the line is a part of.
+    * `character_id`: the internal id of the character who said the line.
+    * `character`: The name of the character.
+    * `movie_id`: the internal id of the movie.
+    * `movie`: The title of the movie.
+    * `year`: The year the movie was released.
+    * `score`: the BM25 relevance of the line.
+    * `snippet`: the text of the line with the matched words wrapped in
+      `<mark>` tags, shortened around the first match for long lines.
+
+    The `limit` and `offset` query parameters are used for pagination.
+    """
+    index = inverted_index.get_index()
+    total, hits = index.search(
+        q, movie_id=movie_id, character_id=character_id,
+        year_min=year_min, year_max=year_max, limit=limit, offset=offset)
+
+    return {
+        "total": total,
+        "results": [index.describe(doc, score, q) for doc, score in hits],
+    }
@@ -1,5 +1,12 @@
-from fastapi import FastAPI
-from src.api import characters, movies, lines, pkg_util, conversations
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, ORJSONResponse
+from src import cancellation
+from src import database as db
+from src.api import characters, movies, lines, pkg_util, conversations, export, search, transcripts, changes
+import anyio
+import os
+import sqlalchemy
+import time
 
 description = """
 Movie API returns dialog statistics on top hollywood movies from decades past.
@@ -8,13 +15,21 @@ Movie API returns dialog statistics on top hollywood movies from decades past.
 
 You can:
 * **list characters with sorting and filtering options.**
+* **suggest characters by name prefix.**
 * **retrieve a specific character by id**
+* **retrieve several characters by id in one request**
+* **list who a character talks to, their top partners, and the shortest
+  chain of conversations between two characters**
+* **retrieve the top and most distinctive words of a character**
 
 ## Movies
 
 You can:
 * **list movies with sorting and filtering options.**
+* **suggest movies by title prefix.**
 * **retrieve a specific movie by id**
+* **retrieve several movies by id in one request**
+* **retrieve the top and most distinctive words of a movie**
 
 ## Lines
 
@@ -22,6 +37,19 @@ You can:
 * **retrieve lines said by a character.**
 * **list lines with sorting and filtering options.**
 * **retrieve lines said to a character with sorting options.**
+* **search lines by relevance, with phrases, filters and highlighting.**
+
+## Conversations
+
+You can:
+* **read the transcript of a conversation in order.**
+* **list the transcripts of the conversations in a movie.**
+* **follow a feed of newly added conversations to keep a copy in sync.**
+
+## Export
+
+You can:
+* **stream a complete table as CSV, NDJSON, Arrow or Parquet.**
 """
 tags_metadata = [
     {
@@ -35,6 +63,14 @@ tags_metadata = [
     {
         "name": "lines",
         "description": "Access information on character lines."
+    },
+    {
+        "name": "conversations",
+        "description": "Read conversations as ordered transcripts."
+    },
+    {
+        "name": "export",
+        "description": "Download complete tables in bulk."
     }
 ]
 
@@ -47,11 +83,79 @@ app = FastAPI(
         "email": "zweinfel@calpoly.edu",
     },
     openapi_tags=tags_metadata,
+    default_response_class=ORJSONResponse,
 )
+# Seconds after a write during which the same client reads from the primary,
+# so it sees its own changes even if the replicas lag behind.
+READ_YOUR_WRITES_SECONDS = float(os.environ.get("READ_YOUR_WRITES_SECONDS", "5"))
+
+
+@app.middleware("http")
+async def ensure_schema(request: Request, call_next):
+    """Creates whatever tables are missing before a process's first request."""
+    if not db.schema_ready:
+        await anyio.to_thread.run_sync(db.ensure_schema)
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def route_reads(request: Request, call_next):
+    """
+    Sends a request's reads to the primary when it is a write, when the
+    client asks for it with the `X-Read-Primary` header, or when the client
+    wrote recently (tracked with the `last_write` cookie).
+    """
+    try:
+        last_write = float(request.cookies.get("last_write", 0) or 0)
+    except ValueError:
+        # The cookie is client input; a mangled one just means no recent write.
+        last_write = 0
+    primary = (
+        request.method not in ("GET", "HEAD")
+        or request.headers.get("x-read-primary", "").lower() in ("1", "true")
+        or time.time() - last_write < READ_YOUR_WRITES_SECONDS
+    )
+    token = db.read_from_primary.set(primary)
+    try:
+        response = await call_next(request)
+    finally:
+        db.read_from_primary.reset(token)
+
+    if request.method not in ("GET", "HEAD") and response.status_code < 400:
+        response.set_cookie("last_write", str(time.time()), max_age=int(READ_YOUR_WRITES_SECONDS) + 1)
+    return response
+
+
+@app.exception_handler(sqlalchemy.exc.OperationalError)
+async def query_canceled(request: Request, exc: sqlalchemy.exc.OperationalError):
+    # 57014 is query_canceled, raised when a statement_timeout is hit or
+    # a request's queries are cancelled by src/admission.py.
+    if getattr(exc.orig, "pgcode", None) == "57014":
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "query took too long, try again later."},
+            headers={"Retry-After": "1"},
+        )
+    raise exc
+
+
+@app.exception_handler(cancellation.RequestAbandoned)
+async def request_abandoned(request: Request, exc: cancellation.RequestAbandoned):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "request deadline exceeded."},
+        headers={"Retry-After": "1"},
+    )
+
+
 app.include_router(characters.router)
 app.include_router(movies.router)
 app.include_router(lines.router)
 app.include_router(conversations.router)
+app.include_router(export.router)
+app.include_router(search.router)
+app.include_router(transcripts.router)
+app.include_router(changes.router)
 app.include_router(pkg_util.router)
 
 
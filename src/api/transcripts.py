@@ -0,0 +1,120 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.params import Query
+from src import admission
+from src import cache
+from src import database as db
+import sqlalchemy
+
+router = APIRouter(dependencies=[admission.limit("cheap")])
+
+
+def get_transcripts(conversation_ids, conn):
+    """
+    Builds the `get_conversation` payload for every id in
+    `conversation_ids` using two queries. The lines are read from
+    `transcripts`, where each conversation's lines are stored next to each
+    other in order. Returns a dict keyed by conversation id; ids that do
+    not exist are left out.
+    """
+    conversation_ids = list(set(conversation_ids))
+    if len(conversation_ids) == 0:
+        return {}
+
+    character1 = db.characters.alias("character1")
+    character2 = db.characters.alias("character2")
+    conversation_info = sqlalchemy.select(
+        db.conversations.c.conversation_id,
+        db.conversations.c.movie_id,
+        db.movies.c.title,
+        db.conversations.c.character1_id,
+        character1.c.name.label("character1_name"),
+        db.conversations.c.character2_id,
+        character2.c.name.label("character2_name"),
+    ).select_from(
+        db.conversations
+        .join(db.movies, db.movies.c.movie_id == db.conversations.c.movie_id)
+        .outerjoin(character1, character1.c.character_id == db.conversations.c.character1_id)
+        .outerjoin(character2, character2.c.character_id == db.conversations.c.character2_id)
+    ).where(db.conversations.c.conversation_id.in_(conversation_ids))
+
+    line_info = sqlalchemy.select(db.transcripts)\
+        .where(db.transcripts.c.conversation_id.in_(conversation_ids))\
+        .order_by(db.transcripts.c.conversation_id, db.transcripts.c.line_sort, db.transcripts.c.line_id)
+
+    json = {}
+    for row in conn.execute(conversation_info):
+        json[row.conversation_id] = {
+            "conversation_id": row.conversation_id,
+            "movie_id": row.movie_id,
+            "movie": row.title,
+            "characters": [
+                {"character_id": row.character1_id, "character": row.character1_name},
+                {"character_id": row.character2_id, "character": row.character2_name},
+            ],
+            "lines": []
+        }
+    for row in conn.execute(line_info):
+        if row.conversation_id in json:
+            json[row.conversation_id]["lines"].append({
+                "line_id": row.line_id,
+                "line_sort": row.line_sort,
+                "character_id": row.character_id,
+                "character": row.character_name,
+                "line_text": row.line_text,
+            })
+    return json
+
+
+@router.get("/conversations/{conversation_id}", tags=["conversations"])
+@cache.cached()
+def get_conversation(conversation_id: int):
+    """
+    This endpoint returns the transcript of a single conversation:
+    * `conversation_id`: the internal id of the conversation.
+    * `movie_id`: the internal id of the movie the conversation is from.
+    * `movie`: The title of the movie.
+    * `characters`: the two characters in the conversation, each with its
+      `character_id` and `character` name.
+    * `lines`: every line of the conversation in the order it was said.
+
+    Each line is represented by a dictionary with the following keys:
+    * `line_id`: the internal id of the line.
+    * `line_sort`: the index of where the line occurred in the conversation.
+    * `character_id`: the internal id of the character who said the line.
+    * `character`: The name of the character.
+    * `line_text`: the text of the line.
+    """
+    with db.read_engine().connect() as conn:
+        transcripts = get_transcripts([conversation_id], conn)
+    if conversation_id not in transcripts:
+        raise HTTPException(status_code=404, detail="conversation not found.")
+    return transcripts[conversation_id]
+
+
+@router.get("/movies/{movie_id}/conversations", tags=["conversations"])
+@cache.cached()
+def list_movie_conversations(
+    movie_id: int,
+    limit: int = Query(10, ge=1, le=50),
+    offset: int = Query(0, ge=0),
+):
+    """
+    This endpoint returns the transcripts of the conversations in a movie,
+    ordered by conversation id. Each conversation has exactly the same
+    shape as the response of `/conversations/{conversation_id}`.
+
+    The `limit` and `offset` query parameters are used for pagination.
+    """
+    stmt = sqlalchemy.select(db.conversations.c.conversation_id)\
+        .where(db.conversations.c.movie_id == movie_id)\
+        .order_by(db.conversations.c.conversation_id)\
+        .limit(limit)\
+        .offset(offset)
+
+    with db.read_engine().connect() as conn:
+        if conn.execute(sqlalchemy.select(db.movies.c.movie_id).where(db.movies.c.movie_id == movie_id)).fetchone() is None:
+            raise HTTPException(status_code=404, detail="movie not found.")
+        conversation_ids = [row.conversation_id for row in conn.execute(stmt)]
+        transcripts = get_transcripts(conversation_ids, conn)
+
+    return [transcripts[conversation_id] for conversation_id in conversation_ids]
@@ -0,0 +1,174 @@
+import functools
+import re
+import threading
+import unicodedata
+from bisect import bisect_left
+
+import numpy as np
+import sqlalchemy
+
+from src import change_log
+from src import database as db
+
+
+def normalize(text):
+    """Lowercases `text`, strips accents and keeps only words and spaces."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    return " ".join(re.findall(r"[a-z0-9]+", text.replace("'", "")))
+
+
+class PrefixIndex:
+    """
+    Prefix matcher over names, ranked by a score.
+
+    Every name is indexed under each of its word suffixes ("star wars" is
+    stored as "star wars" and "wars"), so a query matches names with a
+    word starting with it. The keys are kept in one sorted list, so the
+    keys starting with a prefix are a contiguous range found by bisection.
+    Scores are a NumPy array aligned with `entry_ids` and can be updated in
+    place.
+    """
+
+    def __init__(self, entries):
+        """`entries` is an iterable of `(id, name, score)`."""
+        self._lock = threading.Lock()
+        keys, key_ids, ids, scores = [], [], [], []
+        for id, name, score in entries:
+            ids.append(id)
+            scores.append(score or 0)
+            words = normalize(name).split()
+            for i in range(len(words)):
+                keys.append(" ".join(words[i:]))
+                key_ids.append(id)
+
+        order = np.argsort(np.asarray(ids, dtype=np.int64), kind="stable")
+        self.entry_ids = np.asarray(ids, dtype=np.int64)[order]
+        self.scores = np.asarray(scores, dtype=np.int64)[order]
+
+        key_order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.keys = [keys[i] for i in key_order]
+        self.key_entries = np.searchsorted(self.entry_ids, np.asarray(key_ids, dtype=np.int64)[key_order])
+
+    def search(self, prefix, k):
+        """Returns up to `k` `(id, score)` pairs matching `prefix`, best first."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        lo = bisect_left(self.keys, prefix)
+        hi = bisect_left(self.keys, prefix + "\uffff", lo)
+        entries = np.unique(self.key_entries[lo:hi])
+        scores = self.scores[entries]
+        if len(entries) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            entries, scores = entries[top], scores[top]
+        order = np.lexsort((self.entry_ids[entries], -scores))
+        return list(zip(self.entry_ids[entries][order].tolist(), scores[order].tolist()))
+
+    def add_score(self, id, amount):
+        i = np.searchsorted(self.entry_ids, id)
+        if i < len(self.entry_ids) and self.entry_ids[i] == id:
+            with self._lock:
+                self.scores[i] += amount
+
+
+class Autocomplete:
+    """Prefix indexes of character names and movie titles."""
+
+    def build(self, conn):
+        movies = conn.execute(sqlalchemy.select(
+            db.movies.c.movie_id,
+            db.movies.c.title,
+            db.movies.c.year,
+            db.movies.c.imdb_votes,
+        )).fetchall()
+        self.movie_info = {row.movie_id: row for row in movies}
+        self.movies = PrefixIndex((row.movie_id, row.title, row.imdb_votes) for row in movies)
+
+        characters = conn.execute(sqlalchemy.select(
+            db.characters.c.character_id,
+            db.characters.c.name,
+            db.characters.c.movie_id,
+            db.character_stats.c.num_lines,
+        ).select_from(
+            db.characters.outerjoin(
+                db.character_stats,
+                db.characters.c.character_id == db.character_stats.c.character_id
+            )
+        )).fetchall()
+        self.character_info = {row.character_id: row for row in characters}
+        self.characters = PrefixIndex((row.character_id, row.name, row.num_lines) for row in characters)
+
+    def complete_characters(self, prefix, k):
+        json = []
+        for character_id, num_lines in self.characters.search(prefix, k):
+            character = self.character_info[character_id]
+            movie = self.movie_info.get(character.movie_id)
+            json.append({
+                "character_id": character_id,
+                "character": character.name,
+                "movie_id": character.movie_id,
+                "movie": movie.title if movie else None,
+                "number_of_lines": num_lines,
+            })
+        return json
+
+    def complete_movies(self, prefix, k):
+        json = []
+        for movie_id, imdb_votes in self.movies.search(prefix, k):
+            movie = self.movie_info[movie_id]
+            json.append({
+                "movie_id": movie_id,
+                "movie_title": movie.title,
+                "year": movie.year,
+                "imdb_votes": imdb_votes,
+            })
+        return json
+
+
+def apply_changes(index, conn, changes):
+    """Adds the lines of the conversations in new `changes` rows to the character ranking."""
+    counts = conn.execute(
+        sqlalchemy.select(db.lines.c.character_id, sqlalchemy.func.count())
+        .where(db.lines.c.conversation_id.in_([change.conversation_id for change in changes]))
+        .group_by(db.lines.c.character_id)
+    )
+    for character_id, num_lines in counts:
+        index.characters.add_score(character_id, num_lines)
+
+
+def build_index(conn):
+    index = Autocomplete()
+    index.build(conn)
+    return index
+
+
+_index = None
+_follower = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Returns the process-wide autocomplete index, building it on first use.
+    Lines committed afterwards, here or on other workers, are added to the
+    character ranking from the `changes` log (see `src.change_log`).
+    """
+    global _index, _follower
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index, last_change = change_log.build_at_snapshot(build_index)
+                _follower = change_log.ChangeFollower(
+                    last_change, functools.partial(apply_changes, index), change_log.SYNC_INTERVAL)
+                _follower.sync()
+                _index = index
+    else:
+        _follower.sync_if_due()
+    return _index
+
+
+def sync():
+    """Applies newly committed lines to the character ranking if it is loaded."""
+    if _follower is not None:
+        _follower.sync()
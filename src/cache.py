@@ -0,0 +1,368 @@
+import collections
+import fcntl
+import functools
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from fastapi.responses import Response
+
+from src import database as db
+from src import graph
+from src import singleflight
+from src import words
+from src.api.responses import json_response
+
+logger = logging.getLogger(__name__)
+
+class LRU:
+    """Process-local map that drops its least recently used entries."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedStore:
+    """
+    Cache tier shared by every worker (and, over the network, every
+    serverless instance). Values are bytes stored under a key and a
+    version; bumping the version makes every older entry unreachable.
+
+    `errors` are the exceptions the store raises when it is unavailable.
+    The cache treats them as misses so requests are served uncached.
+    """
+
+    errors = ()
+
+    def get(self, version, key):
+        raise NotImplementedError
+
+    def set(self, version, key, value, ttl):
+        raise NotImplementedError
+
+    def version(self):
+        raise NotImplementedError
+
+    def bump_version(self):
+        raise NotImplementedError
+
+
+class RedisStore(SharedStore):
+    """
+    Shared tier in a Redis server or anything speaking its protocol
+    (Valkey, KeyDB, Dragonfly). Needs the `redis` package. Old versions are
+    left to expire with their TTL.
+    """
+
+    def __init__(self, url, prefix="movie_api:"):
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.25, socket_connect_timeout=0.25)
+        self.prefix = prefix
+        self.errors = (redis.RedisError,)
+
+    def get(self, version, key):
+        return self.client.get(f"{self.prefix}{version}:{key}")
+
+    def set(self, version, key, value, ttl):
+        self.client.set(f"{self.prefix}{version}:{key}", value, ex=max(1, int(ttl)))
+
+    def version(self):
+        return int(self.client.get(f"{self.prefix}version") or 0)
+
+    def bump_version(self):
+        return self.client.incr(f"{self.prefix}version")
+
+
+class MmapStore(SharedStore):
+    """
+    Shared tier in a local directory, for the workers of a single host.
+
+    Every entry is a file in a subdirectory named after its version,
+    written to a temporary name and renamed into place so readers never see
+    half of it, and read through mmap. The version counter is eight bytes
+    of a memory-mapped file, so reading it costs no system call; it is
+    bumped under an exclusive flock, after which older versions are deleted.
+    """
+
+    errors = (OSError, ValueError)
+
+    _VERSION = struct.Struct("<Q")
+    _EXPIRES = struct.Struct("<d")
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._version_path = os.path.join(directory, "version")
+        fd = os.open(self._version_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < self._VERSION.size:
+                os.ftruncate(fd, self._VERSION.size)
+            self._version = mmap.mmap(fd, self._VERSION.size)
+        finally:
+            os.close(fd)
+
+    def _path(self, version, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, str(version), digest)
+
+    def get(self, version, key):
+        try:
+            with open(self._path(version, key), "rb") as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                (expires,) = self._EXPIRES.unpack_from(m)
+                if expires < time.time():
+                    return None
+                return m[self._EXPIRES.size:]
+        except FileNotFoundError:
+            return None
+
+    def set(self, version, key, value, ttl):
+        path = self._path(version, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._EXPIRES.pack(time.time() + ttl))
+                f.write(value)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def version(self):
+        return self._VERSION.unpack_from(self._version)[0]
+
+    def bump_version(self):
+        with open(self._version_path, "rb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            version = self.version() + 1
+            self._VERSION.pack_into(self._version, 0, version)
+        for name in os.listdir(self.directory):
+            if name.isdigit() and int(name) < version:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        return version
+
+
+class TwoLevelCache:
+    """
+    Process-local LRU in front of a `SharedStore`. Keys are looked up under
+    the current data version, so `invalidate` drops every entry of every
+    process at once. The version is re-read from the shared tier at most
+    every `version_ttl` seconds.
+
+    Concurrent misses for the same key in a process share one load (see
+    `src.singleflight`), and the value it stores warms every other process.
+
+    If `invalidate` cannot reach the shared tier, the bump is retried before
+    every later lookup, which loads uncached until it succeeds, so entries
+    from before the write are not served out their TTL.
+    """
+
+    def __init__(self, shared, local_entries=1024, ttl=300, version_ttl=0.0):
+        self.shared = shared
+        self.local = LRU(local_entries)
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        self._version = None
+        self._version_read = 0.0
+        self._invalidation_pending = False
+
+    def version(self):
+        if self._invalidation_pending:
+            self.invalidate()
+        now = time.monotonic()
+        if self._version is None or now - self._version_read >= self.version_ttl:
+            self._version = self.shared.version()
+            self._version_read = now
+        return self._version
+
+    def get(self, version, key):
+        value = self.local.get((version, key))
+        if value is None:
+            try:
+                value = self.shared.get(version, key)
+            except self.shared.errors:
+                return None
+            if value is not None:
+                self.local.set((version, key), value, self.ttl)
+        return value
+
+    def set(self, version, key, value):
+        self.local.set((version, key), value, self.ttl)
+        try:
+            self.shared.set(version, key, value, self.ttl)
+        except self.shared.errors:
+            pass
+
+    def get_or_load(self, key, load):
+        """Returns the value cached under `key`, calling `load` to fill it."""
+        try:
+            version = self.version()
+        except self.shared.errors:
+            return load()
+        value = self.get(version, key)
+        if value is not None:
+            return value
+
+        def fill():
+            # Another process may have stored it while we waited.
+            value = self.get(version, key)
+            if value is None:
+                value = load()
+                self.set(version, key, value)
+            return value
+        return singleflight.flights.do(("cache", version, key), fill)
+
+    def invalidate(self):
+        self._invalidation_pending = True
+        self._version = self.shared.bump_version()
+        self._version_read = time.monotonic()
+        self._invalidation_pending = False
+
+
+_HEADER = struct.Struct(">BH")
+_COMPRESSED = 1
+# Bodies shorter than this are stored as is.
+COMPRESS_ABOVE = 1024
+
+
+def encode(status_code, body):
+    """
+    Packs a response into a flags byte, the status code and the body,
+    deflated when that makes it smaller.
+    """
+    flags = 0
+    if len(body) > COMPRESS_ABOVE:
+        compressed = zlib.compress(body, 1)
+        if len(compressed) < len(body):
+            body, flags = compressed, _COMPRESSED
+    return _HEADER.pack(flags, status_code) + body
+
+
+def decode(data):
+    """Returns the `(status_code, body)` packed by `encode`."""
+    flags, status_code = _HEADER.unpack_from(data)
+    body = data[_HEADER.size:]
+    if flags & _COMPRESSED:
+        body = zlib.decompress(body)
+    return status_code, bytes(body)
+
+
+def from_environment():
+    """
+    Builds the response cache from CACHE_BACKEND: "redis" (at CACHE_URL),
+    "mmap" (in CACHE_DIR) or "none". Without a shared tier nothing is
+    cached, since a process-local cache alone would keep serving entries
+    that a write on another worker has invalidated.
+    """
+    backend = os.environ.get("CACHE_BACKEND", "none")
+    if backend == "redis":
+        shared = RedisStore(os.environ.get("CACHE_URL", "redis://localhost:6379/0"))
+        version_ttl = float(os.environ.get("CACHE_VERSION_TTL", "0.5"))
+    elif backend == "mmap":
+        shared = MmapStore(os.environ.get("CACHE_DIR", os.path.join(tempfile.gettempdir(), "movie_api_cache")))
+        version_ttl = 0.0
+    elif backend == "none":
+        return None
+    else:
+        raise ValueError(f"unknown CACHE_BACKEND {backend!r}")
+    return TwoLevelCache(
+        shared,
+        local_entries=int(os.environ.get("CACHE_LOCAL_ENTRIES", "1024")),
+        ttl=float(os.environ.get("CACHE_TTL", "300")),
+        version_ttl=version_ttl,
+    )
+
+
+response_cache = from_environment()
+
+
+def cached(key=None):
+    """
+    Decorator for read handlers: their JSON responses are kept in the
+    response cache, keyed by the handler and its arguments (see
+    `singleflight.key_function`). Requests that must see their own writes
+    skip it.
+
+    A miss is stored under the version current when it started, which a
+    write bumps only after committing, so the fill must see every write
+    committed by then. It reads from the primary, since a replica may not
+    have replayed them yet, after applying the `changes` log to this
+    worker's graph and word index, which otherwise catch up only every
+    `change_log.SYNC_INTERVAL`. With a cache backend on, cached routes
+    therefore give up the replica offload of `db.read_engine`: the cache
+    takes their load off the primary instead, and replicas serve the
+    uncached routes.
+
+    Concurrent misses for a key share one load, so handlers need no
+    `singleflight.coalesce` of their own; without a response cache, calls
+    are coalesced instead.
+    """
+    def decorator(fn):
+        make_key = singleflight.key_function(fn, key)
+        name = f"{fn.__module__}.{fn.__qualname__}"
+        coalesced = singleflight.coalesce(key)(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if response_cache is None or db.read_from_primary.get():
+                return coalesced(*args, **kwargs)
+
+            def load():
+                graph.sync()
+                words.sync()
+                token = db.read_from_primary.set(True)
+                try:
+                    response = fn(*args, **kwargs)
+                finally:
+                    db.read_from_primary.reset(token)
+                if not isinstance(response, Response):
+                    response = json_response(response)
+                return encode(response.status_code, response.body)
+
+            status_code, body = decode(response_cache.get_or_load(f"{name}:{make_key(args, kwargs)!r}", load))
+            return Response(body, status_code=status_code, media_type="application/json")
+
+        return singleflight.expose_signature(wrapper, fn)
+    return decorator
+
+
+def invalidate():
+    """Drops every cached response, in every process. Call after a write commits."""
+    if response_cache is not None:
+        try:
+            response_cache.invalidate()
+        except response_cache.shared.errors:
+            logger.warning("could not invalidate the response cache, bypassing it until it can", exc_info=True)
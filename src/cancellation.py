@@ -0,0 +1,88 @@
+import contextvars
+import threading
+import weakref
+
+
+class RequestAbandoned(Exception):
+    """Raised when a request asks for a connection after it was cancelled."""
+
+
+# Connections that had a query cancelled. A cancel can arrive after the
+# query it was aimed at, so they are replaced at their next checkout
+# instead of being reused (see `src.database`).
+cancelled_connections = weakref.WeakSet()
+
+
+class QueryTracker:
+    """
+    The database connections a request has checked out, so its queries can
+    be cancelled from another thread once the client is gone or the
+    deadline has passed. A cancelled query fails with `QueryCanceled` in
+    the handler, which then returns its connection to the pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._callbacks = []
+        self.cancelled = False
+
+    def add(self, dbapi_connection):
+        with self._lock:
+            if self.cancelled:
+                raise RequestAbandoned()
+            self._connections.add(dbapi_connection)
+
+    def discard(self, dbapi_connection):
+        with self._lock:
+            self._connections.discard(dbapi_connection)
+
+    def on_cancel(self, callback):
+        """Calls `callback` when the tracker is cancelled, or now if it was."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            for dbapi_connection in self._connections:
+                cancelled_connections.add(dbapi_connection)
+                dbapi_connection.cancel()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+# The QueryTracker of the current request, set by `src.admission`.
+query_tracker = contextvars.ContextVar("query_tracker", default=None)
+
+
+class SharedTracker:
+    """
+    QueryTracker for work done on behalf of several requests: it is
+    cancelled only once every request that joined has been cancelled.
+    Requests without a tracker of their own keep it alive.
+    """
+
+    def __init__(self):
+        self.tracker = QueryTracker()
+        self._lock = threading.Lock()
+        self._owners = 0
+
+    def join(self, owner):
+        with self._lock:
+            self._owners += 1
+        if owner is not None:
+            owner.on_cancel(self._leave)
+
+    def _leave(self):
+        with self._lock:
+            self._owners -= 1
+            last = self._owners == 0
+        if last:
+            self.tracker.cancel()
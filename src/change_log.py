@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+
+import sqlalchemy
+
+from src import database as db
+
+# Seconds between checks of the `changes` log for conversations posted to
+# other workers.
+SYNC_INTERVAL = float(os.environ.get("CHANGE_SYNC_INTERVAL", "1"))
+
+
+def build_at_snapshot(build):
+    """
+    Calls `build(conn)` in a repeatable read transaction and returns its
+    result with the last change id (see `src.schema`) visible to it, so a
+    `ChangeFollower` can pick up exactly where the build stopped. The build
+    runs outside the current request's limits (see `db.unbounded`).
+    """
+    with db.unbounded(), db.engine.connect().execution_options(isolation_level="REPEATABLE READ") as conn:
+        with conn.begin():
+            last_change = conn.execute(sqlalchemy.select(sqlalchemy.func.max(db.changes.c.change_id))).scalar() or 0
+            return build(conn), last_change
+
+
+class ChangeFollower:
+    """
+    Keeps an in-memory structure current by following the `changes` log.
+    Every worker applies every conversation committed after its build, not
+    just the ones it was posted, so all of them answer alike. Change ids
+    become visible in increasing order, so applying those past the last
+    one seen never skips or repeats a conversation.
+
+    `apply(conn, rows)` receives the new `changes` rows (`change_id`,
+    `conversation_id`, `movie_id`) in order and reads what it needs of
+    them with `conn`.
+    """
+
+    def __init__(self, last_change, apply, sync_interval):
+        self.last_change = last_change
+        self.apply = apply
+        self.sync_interval = sync_interval
+        self._synced_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def sync(self, wait=True):
+        """Applies the conversations committed since the last sync."""
+        if not self._lock.acquire(blocking=wait):
+            return
+        try:
+            self._synced_at = time.monotonic()
+            with db.engine.connect() as conn:
+                rows = conn.execute(
+                    sqlalchemy.select(db.changes.c.change_id, db.changes.c.conversation_id, db.changes.c.movie_id)
+                    .where(db.changes.c.change_id > self.last_change)
+                    .order_by(db.changes.c.change_id)
+                ).fetchall()
+                if rows:
+                    self.apply(conn, rows)
+                    self.last_change = rows[-1].change_id
+        finally:
+            self._lock.release()
+
+    def sync_if_due(self):
+        """Syncs if `sync_interval` seconds have passed and no sync is running."""
+        if time.monotonic() - self._synced_at >= self.sync_interval:
+            self.sync(wait=False)
@@ -3,6 +3,14 @@ import os
 import dotenv
 import sqlalchemy
 import dotenv
+import contextlib
+import contextvars
+import itertools
+import threading
+import time
+
+from src import cancellation
+from src import schema
 
 
 def database_connection_url():
@@ -15,8 +23,173 @@ def database_connection_url():
     return f"postgresql://{DB_USER}:{DB_PASSWD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
 
 
+# Milliseconds after which Postgres cancels a statement, set per request by
+# src/admission.py. 0 means no limit.
+statement_timeout = contextvars.ContextVar("statement_timeout", default=0)
+
+# `time.monotonic()` value by which the current request must be done, or
+# None. Statements never get a timeout past it.
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+@contextlib.contextmanager
+def unbounded():
+    """
+    Runs the block without the current request's statement timeout,
+    deadline and cancellation. For building the process-wide indexes: the
+    request that happens to trigger a build is not the only one waiting
+    for it, and a real-size build takes longer than its limits allow.
+    """
+    tokens = [
+        (statement_timeout, statement_timeout.set(0)),
+        (request_deadline, request_deadline.set(None)),
+        (cancellation.query_tracker, cancellation.query_tracker.set(None)),
+    ]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def enforce_statement_timeout(engine):
+    """
+    Applies the current request's `statement_timeout`, shortened to what
+    is left before its deadline, to every connection checked out of
+    `engine`'s pool, and registers the connection with its QueryTracker.
+    """
+    @sqlalchemy.event.listens_for(engine, "checkout")
+    def set_statement_timeout(dbapi_connection, connection_record, connection_proxy):
+        if dbapi_connection in cancellation.cancelled_connections:
+            cancellation.cancelled_connections.discard(dbapi_connection)
+            raise sqlalchemy.exc.DisconnectionError("connection had a query cancelled")
+
+        timeout = statement_timeout.get()
+        deadline = request_deadline.get()
+        if deadline is not None:
+            remaining = max(1, int((deadline - time.monotonic()) * 1000))
+            timeout = min(timeout, remaining) if timeout else remaining
+
+        tracker = cancellation.query_tracker.get()
+        if tracker is not None:
+            tracker.add(dbapi_connection)
+            connection_record.info["query_tracker"] = tracker
+
+        # Pooled connections keep their last setting, so most checkouts need
+        # no round trip. It is set outside a transaction so a rollback does
+        # not undo it.
+        if connection_record.info.get("statement_timeout") != timeout:
+            autocommit = dbapi_connection.autocommit
+            dbapi_connection.autocommit = True
+            try:
+                cursor = dbapi_connection.cursor()
+                cursor.execute("SET statement_timeout = %s", (timeout,))
+                cursor.close()
+            finally:
+                dbapi_connection.autocommit = autocommit
+            connection_record.info["statement_timeout"] = timeout
+
+    @sqlalchemy.event.listens_for(engine, "checkin")
+    def unregister(dbapi_connection, connection_record):
+        tracker = connection_record.info.pop("query_tracker", None)
+        if tracker is not None:
+            tracker.discard(dbapi_connection)
+
+
 # Create a new DB engine based on our connection string
 engine = sqlalchemy.create_engine(database_connection_url())
+enforce_statement_timeout(engine)
+
+
+class ReplicaSet:
+    """
+    Round-robin over read replica engines. A replica is checked with
+    `SELECT 1` when the set is created and then at most once every
+    `check_interval` seconds, and skipped while the last check failed.
+    Later checks run in a background thread, so a slow or unreachable
+    replica never holds up the request that noticed the check was due;
+    `connect_timeout` (seconds) bounds each check.
+    """
+
+    def __init__(self, urls, check_interval=5.0, connect_timeout=2):
+        self.engines = [
+            sqlalchemy.create_engine(url, pool_pre_ping=True, connect_args={"connect_timeout": connect_timeout})
+            for url in urls
+        ]
+        for engine in self.engines:
+            enforce_statement_timeout(engine)
+        self.check_interval = check_interval
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._checking = [False] * len(self.engines)
+        self._checked_at = [time.monotonic()] * len(self.engines)
+        self._healthy = [self._check(i) for i in range(len(self.engines))]
+
+    def _check(self, i):
+        try:
+            with self.engines[i].connect() as conn:
+                conn.execute(sqlalchemy.text("SELECT 1"))
+            return True
+        except sqlalchemy.exc.SQLAlchemyError:
+            return False
+
+    def _check_in_background(self, i):
+        try:
+            self._healthy[i] = self._check(i)
+        finally:
+            self._checking[i] = False
+
+    def _is_healthy(self, i):
+        now = time.monotonic()
+        with self._lock:
+            due = not self._checking[i] and now - self._checked_at[i] >= self.check_interval
+            if due:
+                self._checking[i] = True
+                self._checked_at[i] = now
+        if due:
+            threading.Thread(target=self._check_in_background, args=(i,), daemon=True).start()
+        return self._healthy[i]
+
+    def engine(self):
+        """Returns the next healthy replica engine, or None if all are down."""
+        for _ in range(len(self.engines)):
+            i = next(self._next) % len(self.engines)
+            if self._is_healthy(i):
+                return self.engines[i]
+        return None
+
+
+# Comma separated connection URLs of read replicas. Without any, reads go
+# to the primary.
+replica_urls = [url.strip() for url in os.environ.get("POSTGRES_REPLICA_URLS", "").split(",") if url.strip()]
+replicas = ReplicaSet(replica_urls) if replica_urls else None
+
+# Set for requests that must see their own writes (see server.py).
+read_from_primary = contextvars.ContextVar("read_from_primary", default=False)
+
+
+def dispose_pools():
+    """
+    Drops connections inherited from a parent process without closing them,
+    so a forked worker opens its own instead of sharing the parent's sockets.
+    """
+    engine.dispose(close=False)
+    if replicas is not None:
+        for replica in replicas.engines:
+            replica.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=dispose_pools)
+
+
+def read_engine():
+    """
+    Engine for read-only handlers: a healthy replica when one is configured,
+    otherwise (or when the request needs its own writes) the primary.
+    """
+    if replicas is None or read_from_primary.get():
+        return engine
+    return replicas.engine() or engine
 
 with engine.begin() as conn:
     metadata_obj = sqlalchemy.MetaData()
@@ -26,25 +199,29 @@ with engine.begin() as conn:
     lines = sqlalchemy.Table("lines", metadata_obj, autoload_with=engine)
     movies = sqlalchemy.Table("movies", metadata_obj, autoload_with=engine)
 
-    all_lines = conn.execute(sqlalchemy.select(
-        lines.c.character_id,
-        lines.c.conversation_id
-    )).fetchall()
-    chars_to_num_lines = {}
-    conv_to_num_lines = {}
-    for line in all_lines:
-        if line.character_id in chars_to_num_lines.keys():
-            chars_to_num_lines[line.character_id] += 1
-        else:
-            chars_to_num_lines[line.character_id] = 1
-
-        if line.conversation_id in conv_to_num_lines.keys():
-            conv_to_num_lines[line.conversation_id] += 1
-        else:
-            conv_to_num_lines[line.conversation_id] = 1
+# Created and filled by `ensure_schema`, not at import.
+character_stats, conversation_stats = schema.stats_tables(metadata_obj)
+transcripts = schema.transcripts_table(metadata_obj)
+changes = schema.changes_table(metadata_obj)
 
+schema_ready = False
+_schema_lock = threading.Lock()
 
 
+def ensure_schema():
+    """
+    Runs `schema.setup` once per process: from `main.py` before the workers
+    start, and otherwise on a process's first request (serverless deploys)
+    or test session. After the first run it only checks that everything
+    exists.
+    """
+    global schema_ready
+    if not schema_ready:
+        with _schema_lock:
+            if not schema_ready:
+                with unbounded():
+                    schema.setup(engine, metadata_obj)
+                schema_ready = True
 
 
 # # Create a single connection to the database. Later we will discuss pooling connections.
@@ -0,0 +1,315 @@
+import functools
+import threading
+from array import array
+
+import numpy as np
+import sqlalchemy
+
+from src import change_log
+from src import database as db
+from src.words import tokenize
+
+GENDERS = ("male", "female", "unknown")
+
+# Lower bounds of the conversation length histogram buckets.
+LENGTH_BUCKETS = (1, 3, 5, 9, 17)
+
+
+def gender_code(gender):
+    gender = (gender or "").strip().lower()
+    if gender.startswith("m"):
+        return 0
+    if gender.startswith("f"):
+        return 1
+    return 2
+
+
+def load_columns(conn, movie_id=None):
+    """
+    Reads the columns the statistics are computed from, for one movie or
+    for all of them. Words are counted with the same tokenizer as the
+    `/words` endpoints.
+    """
+    def select(*columns):
+        stmt = sqlalchemy.select(*columns)
+        if movie_id is not None:
+            stmt = stmt.where(columns[0].table.c.movie_id == movie_id)
+        return stmt
+
+    line_movies, line_characters, line_conversations, line_words = (array("q") for _ in range(4))
+    result = conn.execution_options(stream_results=True, yield_per=10000).execute(select(
+        db.lines.c.movie_id,
+        db.lines.c.character_id,
+        db.lines.c.conversation_id,
+        db.lines.c.line_text,
+    ))
+    for line in result:
+        line_movies.append(line.movie_id)
+        line_characters.append(line.character_id)
+        line_conversations.append(line.conversation_id)
+        line_words.append(len(tokenize(line.line_text or "")))
+
+    characters = conn.execute(select(db.characters.c.character_id, db.characters.c.gender)).fetchall()
+    conversations = conn.execute(select(db.conversations.c.conversation_id, db.conversations.c.movie_id)).fetchall()
+
+    return {
+        "line_movies": np.asarray(line_movies, dtype=np.int64),
+        "line_characters": np.asarray(line_characters, dtype=np.int64),
+        "line_conversations": np.asarray(line_conversations, dtype=np.int64),
+        "line_words": np.asarray(line_words, dtype=np.int64),
+        "character_ids": np.asarray([row.character_id for row in characters], dtype=np.int64),
+        "character_genders": np.asarray([gender_code(row.gender) for row in characters], dtype=np.int64),
+        "conversation_ids": np.asarray([row.conversation_id for row in conversations], dtype=np.int64),
+        "conversation_movies": np.asarray([row.movie_id for row in conversations], dtype=np.int64),
+    }
+
+
+def group_quantiles(groups, values, num_groups, quantiles):
+    """
+    Returns, for every quantile, an array with that quantile of `values`
+    within each group (the lower of the two middle values for the median).
+    Empty groups get 0.
+    """
+    order = np.lexsort((values, groups))
+    values = values[order]
+    sizes = np.bincount(groups, minlength=num_groups)
+    starts = np.cumsum(sizes) - sizes
+    result = []
+    for q in quantiles:
+        index = starts + np.floor(q * np.maximum(sizes - 1, 0)).astype(np.int64)
+        picked = values[np.minimum(index, max(len(values) - 1, 0))] if len(values) else np.zeros(num_groups)
+        result.append(np.where(sizes > 0, picked, 0))
+    return result
+
+
+def group_means(groups, values, num_groups):
+    sizes = np.bincount(groups, minlength=num_groups)
+    sums = np.bincount(groups, weights=values, minlength=num_groups)
+    return sums / np.maximum(sizes, 1)
+
+
+def aggregate(movie_ids, columns):
+    """
+    Computes every statistic for the movies in `movie_ids` (sorted) with
+    group-by aggregations over `columns`. Returns a dict of arrays with one
+    entry (or row) per movie.
+    """
+    m = len(movie_ids)
+    line_movie = np.searchsorted(movie_ids, columns["line_movies"])
+    line_words = columns["line_words"]
+
+    num_lines = np.bincount(line_movie, minlength=m)
+    num_words = np.bincount(line_movie, weights=line_words, minlength=m).astype(np.int64)
+
+    # Lines and words of every (movie, character) pair.
+    pairs, pair_of_line = np.unique(
+        np.stack([line_movie, columns["line_characters"]], axis=1), axis=0, return_inverse=True)
+    pair_of_line = pair_of_line.ravel()
+    pair_movie = pairs[:, 0]
+    pair_lines = np.bincount(pair_of_line, minlength=len(pairs))
+    pair_words = np.bincount(pair_of_line, weights=line_words, minlength=len(pairs))
+
+    lines_median, lines_max = group_quantiles(pair_movie, pair_lines, m, (0.5, 1.0))
+    words_median, words_max = group_quantiles(pair_movie, pair_words, m, (0.5, 1.0))
+
+    # The share of lines held by each movie's five most talkative characters.
+    order = np.lexsort((-pair_lines, pair_movie))
+    sizes = np.bincount(pair_movie, minlength=m)
+    rank = np.arange(len(order)) - (np.cumsum(sizes) - sizes)[pair_movie[order]]
+    top = order[rank < 5]
+    top5_lines = np.bincount(pair_movie[top], weights=pair_lines[top], minlength=m)
+
+    # Lines by the gender of the speaker; characters missing from the
+    # characters table count as unknown.
+    character_order = np.argsort(columns["character_ids"])
+    character_ids = columns["character_ids"][character_order]
+    character_genders = columns["character_genders"][character_order]
+    found = np.searchsorted(character_ids, columns["line_characters"])
+    found = np.minimum(found, max(len(character_ids) - 1, 0))
+    line_gender = np.full(len(line_movie), 2, dtype=np.int64)
+    if len(character_ids):
+        known = character_ids[found] == columns["line_characters"]
+        line_gender[known] = character_genders[found[known]]
+    gender_lines = np.bincount(line_movie * 3 + line_gender, minlength=3 * m).reshape(m, 3)
+
+    # Conversation lengths, leaving out conversations without lines.
+    conversation_ids, conversation_lengths = np.unique(columns["line_conversations"], return_counts=True)
+    conversation_order = np.argsort(columns["conversation_ids"])
+    known = np.isin(columns["conversation_ids"][conversation_order], conversation_ids)
+    conversation_movie = np.searchsorted(movie_ids, columns["conversation_movies"][conversation_order][known])
+    conversation_lengths = conversation_lengths[
+        np.searchsorted(conversation_ids, columns["conversation_ids"][conversation_order][known])]
+    length_median, length_p90, length_max = group_quantiles(
+        conversation_movie, conversation_lengths, m, (0.5, 0.9, 1.0))
+    bucket = np.searchsorted(LENGTH_BUCKETS, conversation_lengths, side="right") - 1
+    length_histogram = np.bincount(
+        conversation_movie * len(LENGTH_BUCKETS) + bucket,
+        minlength=m * len(LENGTH_BUCKETS)).reshape(m, len(LENGTH_BUCKETS))
+
+    return {
+        "num_lines": num_lines,
+        "num_words": num_words,
+        "num_characters": sizes,
+        "num_conversations": np.bincount(conversation_movie, minlength=m),
+        "lines_per_character_mean": group_means(pair_movie, pair_lines, m),
+        "lines_per_character_median": lines_median,
+        "lines_per_character_max": lines_max,
+        "words_per_character_mean": group_means(pair_movie, pair_words, m),
+        "words_per_character_median": words_median,
+        "words_per_character_max": words_max,
+        "gender_lines": gender_lines,
+        "female_share": gender_lines[:, 1] / np.maximum(num_lines, 1),
+        "conversation_length_mean": group_means(conversation_movie, conversation_lengths, m),
+        "conversation_length_median": length_median,
+        "conversation_length_p90": length_p90,
+        "conversation_length_max": length_max,
+        "conversation_length_histogram": length_histogram,
+        "top5_share": top5_lines / np.maximum(num_lines, 1),
+    }
+
+
+class DialogueStats:
+    """
+    Dialogue statistics of every movie, kept as one array per statistic.
+
+    Everything is computed in one vectorized pass at build time. A movie
+    touched by a new conversation is marked stale and recomputed from its
+    own rows the next time it is read, and its cached payload dropped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stale = set()
+        self._payloads = {}
+
+    def build(self, conn):
+        movies = conn.execute(
+            sqlalchemy.select(db.movies.c.movie_id, db.movies.c.title).order_by(db.movies.c.movie_id)
+        ).fetchall()
+        self.movie_ids = np.asarray([row.movie_id for row in movies], dtype=np.int64)
+        self.titles = {row.movie_id: row.title for row in movies}
+        self.stats = aggregate(self.movie_ids, load_columns(conn))
+
+    def invalidate(self, movie_id):
+        with self._lock:
+            self._stale.add(movie_id)
+            self._payloads.pop(movie_id, None)
+
+    def _refresh(self):
+        with self._lock:
+            if not self._stale:
+                return
+            with db.engine.connect() as conn:
+                for movie_id in self._stale:
+                    i = np.searchsorted(self.movie_ids, movie_id)
+                    if i == len(self.movie_ids) or self.movie_ids[i] != movie_id:
+                        continue
+                    fresh = aggregate(self.movie_ids[i:i + 1], load_columns(conn, movie_id))
+                    for name, values in fresh.items():
+                        self.stats[name][i] = values[0]
+            self._stale.clear()
+
+    def movie(self, movie_id):
+        """Returns the statistics of one movie, or None if it does not exist."""
+        if movie_id in self._stale:
+            self._refresh()
+        payload = self._payloads.get(movie_id)
+        if payload is None:
+            i = np.searchsorted(self.movie_ids, movie_id)
+            if i == len(self.movie_ids) or self.movie_ids[i] != movie_id:
+                return None
+            # Under the lock so a concurrent invalidation cannot be undone
+            # by caching a payload built from the old arrays.
+            with self._lock:
+                if movie_id not in self._stale:
+                    payload = self._payloads[movie_id] = self._payload(i)
+            if payload is None:
+                return self.movie(movie_id)
+        return payload
+
+    def ranking(self, sort, limit, offset):
+        """Returns the statistics of the movies with the highest `sort` value."""
+        self._refresh()
+        order = np.lexsort((self.movie_ids, -self.stats[sort]))[offset:offset + limit]
+        return [self.movie(movie_id) for movie_id in self.movie_ids[order].tolist()]
+
+    def _payload(self, i):
+        stats = {name: values[i] for name, values in self.stats.items()}
+        num_lines = int(stats["num_lines"])
+        movie_id = int(self.movie_ids[i])
+
+        def summary(prefix):
+            return {
+                "mean": round(float(stats[prefix + "_mean"]), 2),
+                "median": int(stats[prefix + "_median"]),
+                "max": int(stats[prefix + "_max"]),
+            }
+
+        buckets = list(LENGTH_BUCKETS) + [None]
+        return {
+            "movie_id": movie_id,
+            "title": self.titles[movie_id],
+            "num_lines": num_lines,
+            "num_words": int(stats["num_words"]),
+            "num_characters": int(stats["num_characters"]),
+            "num_conversations": int(stats["num_conversations"]),
+            "lines_per_character": summary("lines_per_character"),
+            "words_per_character": summary("words_per_character"),
+            "gender_split": {
+                gender: round(int(lines) / max(num_lines, 1), 4)
+                for gender, lines in zip(GENDERS, stats["gender_lines"])
+            },
+            "conversation_length": {
+                **summary("conversation_length"),
+                "p90": int(stats["conversation_length_p90"]),
+                "histogram": [
+                    {"min": low, "max": None if high is None else high - 1, "count": int(count)}
+                    for low, high, count in zip(buckets, buckets[1:], stats["conversation_length_histogram"])
+                ],
+            },
+            "top5_share": round(float(stats["top5_share"]), 4),
+        }
+
+
+def apply_changes(stats, conn, changes):
+    """Marks the movies of new `changes` rows as stale in `stats`."""
+    for change in changes:
+        stats.invalidate(change.movie_id)
+
+
+def build_stats(conn):
+    stats = DialogueStats()
+    stats.build(conn)
+    return stats
+
+
+_stats = None
+_follower = None
+_stats_lock = threading.Lock()
+
+
+def get_stats():
+    """
+    Returns the process-wide dialogue statistics, computing them on first
+    use. Movies that get conversations afterwards, here or on other
+    workers, are marked stale from the `changes` log (see
+    `src.change_log`).
+    """
+    global _stats, _follower
+    if _stats is None:
+        with _stats_lock:
+            if _stats is None:
+                stats, last_change = change_log.build_at_snapshot(build_stats)
+                _follower = change_log.ChangeFollower(
+                    last_change, functools.partial(apply_changes, stats), change_log.SYNC_INTERVAL)
+                _follower.sync()
+                _stats = stats
+    else:
+        _follower.sync_if_due()
+    return _stats
+
+
+def sync():
+    """Marks the movies of newly committed conversations as stale if the statistics are loaded."""
+    if _follower is not None:
+        _follower.sync()
@@ -0,0 +1,217 @@
+import functools
+import threading
+from collections import deque
+
+import numpy as np
+import sqlalchemy
+
+from src import change_log
+from src import database as db
+
+
+class InteractionGraph:
+    """
+    Who-talks-to-whom graph stored in CSR form.
+
+    For the node at index `i` of `node_ids`, its neighbors are
+    `indices[indptr[i]:indptr[i + 1]]` and the lines spoken together are
+    the matching slice of `weights`. Each row is sorted by weight (highest
+    first, ties broken by character id), so the top k partners are just
+    the first k entries of the row.
+
+    Conversations added after the build are kept in a small `pending`
+    overlay and merged into the arrays once it grows past
+    `compact_threshold` edges. Readers take the CSR arrays and their
+    pending rows under the lock, so they never mix two versions.
+    """
+
+    compact_threshold = 10000
+
+    def __init__(self, src, dst, weights, movie_of):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._num_pending = 0
+        self.movie_of = dict(movie_of)
+        self._build(src, dst, weights)
+
+    def _build(self, src, dst, weights):
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.int64)
+
+        # Sum the weights of every (src, dst) pair into a single edge.
+        pairs = np.stack([src, dst], axis=1)
+        pairs, inverse = np.unique(pairs, axis=0, return_inverse=True)
+        weights = np.bincount(inverse.ravel(), weights=weights, minlength=len(pairs)).astype(np.int64)
+        src, dst = pairs[:, 0], pairs[:, 1]
+
+        node_ids = np.unique(src)
+        rows = np.searchsorted(node_ids, src)
+        order = np.lexsort((dst, -weights, rows))
+
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(node_ids)), out=indptr[1:])
+
+        # Swapped in as one tuple so readers never see arrays from two builds.
+        self._csr = (node_ids, indptr, dst[order], weights[order])
+
+    def _snapshot(self, id):
+        """Returns the CSR arrays and a copy of `id`'s pending row."""
+        with self._lock:
+            return self._csr, dict(self._pending.get(id, {}))
+
+    @staticmethod
+    def _row(csr, id):
+        node_ids, indptr, indices, weights = csr
+        i = np.searchsorted(node_ids, id)
+        if i == len(node_ids) or node_ids[i] != id:
+            return indices[:0], weights[:0]
+        start, end = indptr[i], indptr[i + 1]
+        return indices[start:end], weights[start:end]
+
+    def neighbors(self, id):
+        """
+        Returns a list of `(character_id, lines_together)` tuples for
+        every character `id` has talked to, highest weight first.
+        """
+        csr, pending = self._snapshot(id)
+        indices, weights = self._row(csr, id)
+        if not pending:
+            return list(zip(indices.tolist(), weights.tolist()))
+
+        merged = dict(zip(indices.tolist(), weights.tolist()))
+        for other_id, weight in pending.items():
+            merged[other_id] = merged.get(other_id, 0) + weight
+        return sorted(merged.items(), key=lambda x: (-x[1], x[0]))
+
+    def top_partners(self, id, k):
+        csr, pending = self._snapshot(id)
+        if not pending:
+            indices, weights = self._row(csr, id)
+            return list(zip(indices[:k].tolist(), weights[:k].tolist()))
+        return self.neighbors(id)[:k]
+
+    def shortest_path(self, start, goal):
+        """
+        Breadth-first search for the fewest conversations linking `start`
+        to `goal`. Returns the list of character ids on the path, or None
+        if the two characters are not connected.
+        """
+        if start == goal:
+            return [start]
+        parent = {start: None}
+        queue = deque([start])
+        while queue:
+            node = queue.popleft()
+            for other_id, _ in self.neighbors(node):
+                if other_id in parent:
+                    continue
+                parent[other_id] = node
+                if other_id == goal:
+                    path = [goal]
+                    while parent[path[-1]] is not None:
+                        path.append(parent[path[-1]])
+                    return path[::-1]
+                queue.append(other_id)
+        return None
+
+    def add_conversation(self, c1_id, c2_id, movie_id, num_lines):
+        with self._lock:
+            for a, b in ((c1_id, c2_id), (c2_id, c1_id)):
+                row = self._pending.setdefault(a, {})
+                row[b] = row.get(b, 0) + num_lines
+                self.movie_of[a] = movie_id
+            self._num_pending += 2
+            if self._num_pending >= self.compact_threshold:
+                self._compact()
+
+    def _compact(self):
+        node_ids, indptr, dst, weights = self._csr
+        src = np.repeat(node_ids, np.diff(indptr))
+        pending = [(a, b, w) for a, row in self._pending.items() for b, w in row.items()]
+        if pending:
+            p_src, p_dst, p_weights = zip(*pending)
+            src = np.concatenate([src, p_src])
+            dst = np.concatenate([dst, p_dst])
+            weights = np.concatenate([weights, p_weights])
+        self._build(src, dst, weights)
+        self._pending = {}
+        self._num_pending = 0
+
+
+def build_graph(conn):
+    """Builds the graph from `conversations` and `conversation_stats`."""
+    convs = conn.execute(conversation_edges()).fetchall()
+
+    c1 = [conv.character1_id for conv in convs]
+    c2 = [conv.character2_id for conv in convs]
+    weights = [conv.num_lines for conv in convs]
+    movie_of = {}
+    for conv in convs:
+        movie_of[conv.character1_id] = conv.movie_id
+        movie_of[conv.character2_id] = conv.movie_id
+
+    # Every conversation is an edge in both directions.
+    return InteractionGraph(c1 + c2, c2 + c1, weights + weights, movie_of)
+
+
+def conversation_edges():
+    return sqlalchemy.select(
+        db.conversations.c.conversation_id,
+        db.conversations.c.character1_id,
+        db.conversations.c.character2_id,
+        db.conversations.c.movie_id,
+        sqlalchemy.func.coalesce(db.conversation_stats.c.num_lines, 0).label("num_lines"),
+    ).select_from(
+        db.conversations.outerjoin(
+            db.conversation_stats,
+            db.conversations.c.conversation_id == db.conversation_stats.c.conversation_id
+        )
+    )
+
+
+def apply_changes(interactions, conn, changes):
+    """Adds the conversations of new `changes` rows to `interactions`."""
+    edges = {
+        conv.conversation_id: conv
+        for conv in conn.execute(conversation_edges().where(
+            db.conversations.c.conversation_id.in_([change.conversation_id for change in changes])))
+    }
+    for change in changes:
+        conv = edges.get(change.conversation_id)
+        if conv is not None:
+            interactions.add_conversation(conv.character1_id, conv.character2_id, conv.movie_id, conv.num_lines)
+
+
+_graph = None
+_follower = None
+_graph_lock = threading.Lock()
+
+
+def get_graph():
+    """
+    Returns the process-wide graph, building it on first use and applying
+    the conversations other workers have committed at most every
+    `change_log.SYNC_INTERVAL` seconds.
+    """
+    global _graph, _follower
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                interactions, last_change = change_log.build_at_snapshot(build_graph)
+                _follower = change_log.ChangeFollower(
+                    last_change, functools.partial(apply_changes, interactions), change_log.SYNC_INTERVAL)
+                _follower.sync()
+                _graph = interactions
+    else:
+        _follower.sync_if_due()
+    return _graph
+
+
+def sync():
+    """
+    Brings the graph up to date after this process committed conversations,
+    so the writer reads its own writes without waiting for the interval.
+    """
+    if _follower is not None:
+        _follower.sync()
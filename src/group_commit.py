@@ -0,0 +1,96 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending:
+    def __init__(self, item):
+        self.item = item
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GroupCommitter:
+    """
+    Batches writes from many request threads into a few transactions.
+
+    `submit` queues an item and blocks until a background worker has passed
+    it to `flush` together with whatever else arrived within `max_delay`
+    seconds (or until `max_batch` items are waiting). `flush` receives a
+    list of items, must write them in one transaction and returns one
+    result per item. If a batch fails, its items are retried one at a time
+    so a single bad item only fails its own caller.
+
+    `after_commit`, if given, receives the results of every committed
+    batch before its callers are released. It runs outside the retry path:
+    the batch is already saved, so its errors are logged rather than
+    failing the callers or writing the items again.
+    """
+
+    def __init__(self, flush, after_commit=None, max_batch=100, max_delay=0.005):
+        self.flush = flush
+        self.after_commit = after_commit
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._start_lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._worker.start()
+
+    def submit(self, item):
+        # Threads do not survive a fork, so a forked worker starts its own.
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self._start()
+        pending = _Pending(item)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            results = self.flush([pending.item for pending in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+                batch[0].done.set()
+                return
+            for pending in batch:
+                self._commit([pending])
+            return
+
+        if self.after_commit is not None:
+            try:
+                self.after_commit(results)
+            except Exception:
+                logger.exception("after_commit failed for a committed batch of %d items", len(batch))
+
+        for pending, result in zip(batch, results):
+            pending.result = result
+            pending.done.set()
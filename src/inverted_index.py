@@ -0,0 +1,397 @@
+import functools
+import html
+import math
+import re
+import threading
+from array import array
+from collections import Counter
+
+import numpy as np
+import sqlalchemy
+
+from src import change_log
+from src import database as db
+from src.words import tokenize
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+SNIPPET_LENGTH = 200
+
+
+class _Column:
+    """Append-only NumPy column that grows by doubling its capacity."""
+
+    def __init__(self, values, dtype):
+        self.data = np.asarray(values, dtype=dtype)
+        self.size = len(self.data)
+
+    def append(self, value):
+        if self.size == len(self.data):
+            grown = np.empty(max(2 * len(self.data), 1024), dtype=self.data.dtype)
+            grown[:self.size] = self.data
+            self.data = grown
+        self.data[self.size] = value
+        self.size += 1
+
+    def view(self):
+        return self.data[:self.size]
+
+
+class LineIndex:
+    """
+    Inverted index over `lines` for BM25 ranked search.
+
+    Every line is a document. The posting list of a term is
+    `docs[ptr[t]:ptr[t + 1]]` with the matching term frequencies in `tfs`.
+    Per-document attributes used for filtering are NumPy columns, so a
+    query only touches the posting lists of its own terms.
+
+    Lines added after the build are appended to the document columns right
+    away and their postings kept in a `pending` overlay that is merged into
+    the arrays once it grows past `compact_threshold` postings. The arrays
+    and the overlay are swapped together as one `_snapshot` tuple, which a
+    search reads once, so it never sees merged postings next to the overlay
+    they came from.
+    """
+
+    compact_threshold = 50000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.vocab = {}
+        self.texts = []
+        self.character_names = {}
+        self.movie_titles = {}
+        self.movie_years = {}
+        self._num_pending = 0
+        self._set_columns([], [], [], [], [])
+        self._snapshot = (self._build_postings([], [], []), {})
+
+    def _set_columns(self, line_ids, movie_ids, character_ids, conversation_ids, lengths):
+        self.line_ids = _Column(line_ids, np.int64)
+        self.movie_ids = _Column(movie_ids, np.int64)
+        self.character_ids = _Column(character_ids, np.int64)
+        self.conversation_ids = _Column(conversation_ids, np.int64)
+        self.lengths = _Column(lengths, np.int32)
+        self.years = _Column([self.movie_years.get(m, -1) for m in movie_ids], np.int32)
+        self.total_length = int(self.lengths.view().sum())
+
+    def build(self, conn):
+        for row in conn.execute(sqlalchemy.select(db.characters.c.character_id, db.characters.c.name)):
+            self.character_names[row.character_id] = row.name
+        for row in conn.execute(sqlalchemy.select(db.movies.c.movie_id, db.movies.c.title, db.movies.c.year)):
+            self.movie_titles[row.movie_id] = row.title
+            self.movie_years[row.movie_id] = parse_year(row.year)
+
+        line_ids, movie_ids, character_ids, conversation_ids, lengths = (array("q") for _ in range(5))
+        post_terms, post_docs, post_tfs = array("q"), array("q"), array("q")
+        result = conn.execution_options(stream_results=True, yield_per=10000).execute(
+            sqlalchemy.select(
+                db.lines.c.line_id,
+                db.lines.c.character_id,
+                db.lines.c.movie_id,
+                db.lines.c.conversation_id,
+                db.lines.c.line_text
+            ).order_by(db.lines.c.line_id)
+        )
+        for doc, line in enumerate(result):
+            text = line.line_text or ""
+            tokens = tokenize(text)
+            for term, tf in Counter(tokens).items():
+                post_terms.append(self._term_id(term))
+                post_docs.append(doc)
+                post_tfs.append(tf)
+            line_ids.append(line.line_id)
+            movie_ids.append(line.movie_id)
+            character_ids.append(line.character_id)
+            conversation_ids.append(line.conversation_id)
+            lengths.append(len(tokens))
+            self.texts.append(text)
+
+        self._set_columns(line_ids, movie_ids, character_ids, conversation_ids, lengths)
+        self._snapshot = (self._build_postings(post_terms, post_docs, post_tfs), {})
+
+    def _term_id(self, term):
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            term_id = self.vocab[term] = len(self.vocab)
+        return term_id
+
+    def _build_postings(self, terms, docs, tfs):
+        terms = np.asarray(terms, dtype=np.int64)
+        docs = np.asarray(docs, dtype=np.int32)
+        tfs = np.asarray(tfs, dtype=np.int32)
+        order = np.lexsort((docs, terms))
+        ptr = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(self.vocab)), out=ptr[1:])
+        return ptr, docs[order], tfs[order]
+
+    def postings(self, term_id, snapshot=None):
+        (ptr, docs, tfs), pending = snapshot or self._snapshot
+        if term_id + 1 < len(ptr):
+            docs, tfs = docs[ptr[term_id]:ptr[term_id + 1]], tfs[ptr[term_id]:ptr[term_id + 1]]
+        else:
+            docs, tfs = docs[:0], tfs[:0]
+        pending = pending.get(term_id)
+        if pending:
+            p_docs, p_tfs = list(pending[0]), list(pending[1])
+            docs = np.concatenate([docs, np.asarray(p_docs[:len(p_tfs)], dtype=np.int32)])
+            tfs = np.concatenate([tfs, np.asarray(p_tfs[:len(p_docs)], dtype=np.int32)])
+        return docs, tfs
+
+    def add_lines(self, lines):
+        """`lines` is a list of dicts with the columns of the `lines` table."""
+        with self._lock:
+            pending = self._snapshot[1]
+            for line in lines:
+                doc = len(self.texts)
+                tokens = tokenize(line["line_text"])
+                for term, tf in Counter(tokens).items():
+                    p_docs, p_tfs = pending.setdefault(self._term_id(term), ([], []))
+                    p_docs.append(doc)
+                    p_tfs.append(tf)
+                    self._num_pending += 1
+                self.line_ids.append(line["line_id"])
+                self.movie_ids.append(line["movie_id"])
+                self.character_ids.append(line["character_id"])
+                self.conversation_ids.append(line["conversation_id"])
+                self.lengths.append(len(tokens))
+                self.years.append(self.movie_years.get(line["movie_id"], -1))
+                self.total_length += len(tokens)
+                # Appended last: a document is searchable once its text exists.
+                self.texts.append(line["line_text"])
+            if self._num_pending >= self.compact_threshold:
+                self._compact()
+
+    def _compact(self):
+        (ptr, docs, tfs), pending = self._snapshot
+        terms = [np.repeat(np.arange(len(ptr) - 1), np.diff(ptr))]
+        docs, tfs = [docs], [tfs]
+        for term_id, (p_docs, p_tfs) in pending.items():
+            terms.append(np.full(len(p_docs), term_id))
+            docs.append(np.asarray(p_docs, dtype=np.int32))
+            tfs.append(np.asarray(p_tfs, dtype=np.int32))
+        postings = self._build_postings(np.concatenate(terms), np.concatenate(docs), np.concatenate(tfs))
+        self._snapshot = (postings, {})
+        self._num_pending = 0
+
+    def search(self, query, movie_id=None, character_id=None, year_min=None, year_max=None,
+               limit=20, offset=0):
+        """
+        Returns `(total_matches, hits)` where `hits` is a list of
+        `(doc, score)` for the requested page, best first. Quoted parts of
+        `query` are phrases that must appear in the line; other terms are
+        optional and only add to the score. For phrase queries the total is
+        an upper bound.
+        """
+        terms, phrases = parse_query(query)
+        term_ids = {self.vocab[t] for t in terms + [t for p in phrases for t in p] if t in self.vocab}
+        if len(term_ids) == 0 or any(t not in self.vocab for p in phrases for t in p):
+            return 0, []
+
+        snapshot = self._snapshot
+        num_docs = len(self.texts)
+        lengths = self.lengths.view()
+        avg_length = self.total_length / max(num_docs, 1)
+
+        all_docs, all_scores = [], []
+        postings = {}
+        for term_id in term_ids:
+            docs, tfs = self.postings(term_id, snapshot)
+            # Skip lines whose text is still being added.
+            searchable = docs < num_docs
+            docs, tfs = docs[searchable], tfs[searchable]
+            postings[term_id] = docs
+            idf = math.log(1 + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = K1 * (1 - B + B * lengths[docs] / avg_length)
+            all_docs.append(docs)
+            all_scores.append(idf * tfs * (K1 + 1) / (tfs + norm))
+
+        if len(all_docs) == 1:
+            # A posting list holds each line once, in order.
+            docs, scores = all_docs[0], all_scores[0]
+        else:
+            docs, inverse = np.unique(np.concatenate(all_docs), return_inverse=True)
+            scores = np.bincount(inverse.ravel(), weights=np.concatenate(all_scores))
+
+        mask = np.ones(len(docs), dtype=bool)
+        for phrase in phrases:
+            for term in phrase:
+                mask &= np.isin(docs, postings[self.vocab[term]])
+        if movie_id is not None:
+            mask &= self.movie_ids.view()[docs] == movie_id
+        if character_id is not None:
+            mask &= self.character_ids.view()[docs] == character_id
+        if year_min is not None:
+            mask &= self.years.view()[docs] >= year_min
+        if year_max is not None:
+            years = self.years.view()[docs]
+            mask &= (years >= 0) & (years <= year_max)
+        docs, scores = docs[mask], scores[mask]
+
+        if not phrases:
+            page = top(docs, scores, offset + limit)[offset:]
+            return len(docs), list(zip(docs[page].tolist(), scores[page].tolist()))
+
+        # Every phrase word is in these lines; check the words are adjacent,
+        # stopping as soon as the requested page is filled. The total is
+        # then the number of lines containing every phrase word.
+        hits = []
+        matched = 0
+        for i in ranked(docs, scores, 2 * (offset + limit)):
+            tokens = tokenize(self.texts[docs[i]])
+            if all(contains_phrase(tokens, phrase) for phrase in phrases):
+                if matched >= offset:
+                    hits.append((int(docs[i]), float(scores[i])))
+                matched += 1
+                if len(hits) == limit:
+                    break
+        return len(docs), hits
+
+    def describe(self, doc, score, query):
+        movie_id = int(self.movie_ids.data[doc])
+        character_id = int(self.character_ids.data[doc])
+        year = int(self.years.data[doc])
+        return {
+            "line_id": int(self.line_ids.data[doc]),
+            "conv_id": int(self.conversation_ids.data[doc]),
+            "character_id": character_id,
+            "character": self.character_names.get(character_id),
+            "movie_id": movie_id,
+            "movie": self.movie_titles.get(movie_id),
+            "year": year if year >= 0 else None,
+            "score": round(score, 4),
+            "snippet": highlight(self.texts[doc], query),
+        }
+
+
+def top(docs, scores, k):
+    """
+    Returns the positions of the `k` best matches, by descending score and
+    then by line. Only the matches scoring at least the k-th best score are
+    sorted.
+    """
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        kth = -np.partition(-scores, k - 1)[k - 1]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.lexsort((docs[candidates], -scores[candidates]))][:k]
+
+
+def ranked(docs, scores, k):
+    """Yields every position in the order of `top`, sorting `k` more at a time as needed."""
+    seen = 0
+    while seen < len(scores):
+        order = top(docs, scores, seen + k)
+        yield from order[seen:].tolist()
+        seen = len(order)
+        k *= 2
+
+
+def parse_year(year):
+    try:
+        return int(year)
+    except (TypeError, ValueError):
+        return -1
+
+
+def parse_query(query):
+    """Splits a query into loose terms and quoted phrases, both tokenized."""
+    terms, phrases = [], []
+    for phrase, term in re.findall(r'"([^"]*)"|(\S+)', query):
+        if phrase:
+            tokens = tokenize(phrase)
+            if len(tokens) > 1:
+                phrases.append(tokens)
+            else:
+                terms.extend(tokens)
+        else:
+            terms.extend(tokenize(term))
+    return terms, phrases
+
+
+def contains_phrase(tokens, phrase):
+    n = len(phrase)
+    return any(tokens[i:i + n] == phrase for i in range(len(tokens) - n + 1))
+
+
+def highlight(text, query):
+    """
+    Wraps the query's words in `<mark>` tags and trims long lines to a
+    window around the first match. The line itself is HTML-escaped, since
+    its text comes from API users.
+    """
+    terms, phrases = parse_query(query)
+    words = sorted(set(terms + [t for p in phrases for t in p]), key=len, reverse=True)
+    pattern = re.compile(r"(?<![\w'])(" + "|".join(map(re.escape, words)) + r")(?![\w'])", re.IGNORECASE)
+
+    match = pattern.search(text)
+    if len(text) > SNIPPET_LENGTH:
+        start = max(0, (match.start() if match else 0) - SNIPPET_LENGTH // 4)
+        end = start + SNIPPET_LENGTH
+        text = ("..." if start > 0 else "") + text[start:end] + ("..." if end < len(text) else "")
+    parts, end = [], 0
+    for match in pattern.finditer(text):
+        parts.append(html.escape(text[end:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group(1))}</mark>")
+        end = match.end()
+    parts.append(html.escape(text[end:]))
+    return "".join(parts)
+
+
+def apply_changes(index, conn, changes):
+    """Adds the lines of the conversations in new `changes` rows to `index`."""
+    lines = conn.execute(
+        sqlalchemy.select(
+            db.lines.c.line_id,
+            db.lines.c.character_id,
+            db.lines.c.movie_id,
+            db.lines.c.conversation_id,
+            db.lines.c.line_text
+        )
+        .where(db.lines.c.conversation_id.in_([change.conversation_id for change in changes]))
+        .order_by(db.lines.c.line_id)
+    )
+    index.add_lines([dict(line._mapping, line_text=line.line_text or "") for line in lines])
+
+
+def build_index(conn):
+    index = LineIndex()
+    index.build(conn)
+    return index
+
+
+_index = None
+_follower = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Returns the process-wide search index, building it on first use. Lines
+    committed while it builds, here or on other workers, are applied from
+    the `changes` log afterwards (see `src.change_log`).
+    """
+    global _index, _follower
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index, last_change = change_log.build_at_snapshot(build_index)
+                _follower = change_log.ChangeFollower(
+                    last_change, functools.partial(apply_changes, index), change_log.SYNC_INTERVAL)
+                _follower.sync()
+                _index = index
+    else:
+        _follower.sync_if_due()
+    return _index
+
+
+def sync():
+    """Applies newly committed lines to the search index if it is loaded."""
+    if _follower is not None:
+        _follower.sync()
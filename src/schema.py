@@ -0,0 +1,308 @@
+"""
+Schema the API relies on beyond the source tables: the indexes behind its
+hot queries, and summary tables kept next to the source tables so that
+line counts are an indexed single-table read instead of an aggregate over
+`lines`:
+
+* `character_stats`: lines spoken by each character.
+* `conversation_stats`: lines in each conversation.
+
+Per-movie counts are served by `/movies/{movie_id}/stats` from
+`src.dialogue_stats`.
+
+`transcripts` holds every line with its speaker's name, keyed and
+clustered by `(conversation_id, line_sort)`, so reading a conversation in
+order is one range read of adjacent rows.
+
+`changes` is an append-only log with one row per conversation added
+through the API, numbered in commit order, which `/changes` serves to
+mirrors.
+
+Nothing here runs when the app is imported. `python -m src.schema setup`
+creates whatever is missing (tables, then the indexes in `INDEXES`) and
+fills new tables. `main.py` runs it before starting the workers, and
+`database.ensure_schema` on a process's first request otherwise, so a
+deploy without a setup step still works. `add_conversation` keeps the tables current with
+`record_conversation`, `record_transcripts` and `record_changes`.
+`python -m src.schema refresh` rebuilds them from scratch, e.g. from a
+cron job; the rebuild upserts rows in place, so readers are never
+blocked. With no command, both run. `test_query_plans` checks that the
+routes' queries use the indexes.
+"""
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+
+def stats_tables(metadata_obj):
+    character_stats = sqlalchemy.Table(
+        "character_stats",
+        metadata_obj,
+        sqlalchemy.Column("character_id", sqlalchemy.BigInteger, primary_key=True),
+        sqlalchemy.Column("num_lines", sqlalchemy.BigInteger, nullable=False),
+    )
+    conversation_stats = sqlalchemy.Table(
+        "conversation_stats",
+        metadata_obj,
+        sqlalchemy.Column("conversation_id", sqlalchemy.BigInteger, primary_key=True),
+        sqlalchemy.Column("num_lines", sqlalchemy.BigInteger, nullable=False),
+    )
+    return character_stats, conversation_stats
+
+
+def transcripts_table(metadata_obj):
+    return sqlalchemy.Table(
+        "transcripts",
+        metadata_obj,
+        sqlalchemy.Column("conversation_id", sqlalchemy.BigInteger, nullable=False),
+        sqlalchemy.Column("line_sort", sqlalchemy.BigInteger, nullable=False),
+        sqlalchemy.Column("line_id", sqlalchemy.BigInteger, nullable=False),
+        sqlalchemy.Column("movie_id", sqlalchemy.BigInteger, nullable=False),
+        sqlalchemy.Column("character_id", sqlalchemy.BigInteger, nullable=False),
+        sqlalchemy.Column("character_name", sqlalchemy.Text),
+        sqlalchemy.Column("line_text", sqlalchemy.Text),
+        sqlalchemy.PrimaryKeyConstraint("conversation_id", "line_sort", "line_id", name="transcripts_pkey"),
+    )
+
+
+def changes_table(metadata_obj):
+    return sqlalchemy.Table(
+        "changes",
+        metadata_obj,
+        sqlalchemy.Column("change_id", sqlalchemy.BigInteger, sqlalchemy.Identity(), primary_key=True),
+        sqlalchemy.Column("conversation_id", sqlalchemy.BigInteger, nullable=False),
+        sqlalchemy.Column("movie_id", sqlalchemy.BigInteger, nullable=False),
+    )
+
+
+# Columns the API filters, joins or sorts on, as (table, index name,
+# columns, optionally columns to include). A column name starting with "-"
+# is indexed in descending order. Included columns let the list endpoints
+# read their pages from the index alone.
+INDEXES = [
+    ("lines", "ix_lines_character_id", ["character_id"]),
+    ("lines", "ix_lines_conversation_id_line_sort", ["conversation_id", "line_sort"]),
+    ("lines", "ix_lines_movie_id", ["movie_id"]),
+    ("conversations", "ix_conversations_character1_id", ["character1_id"]),
+    ("conversations", "ix_conversations_character2_id", ["character2_id"]),
+    ("conversations", "ix_conversations_movie_id", ["movie_id"]),
+    ("characters", "ix_characters_movie_id", ["movie_id"]),
+    ("characters", "ix_characters_name_covering", ["name", "character_id"], ["movie_id", "gender"]),
+    ("characters", "ix_characters_gender_name", ["gender", "name", "character_id"], ["movie_id"]),
+    ("character_stats", "ix_character_stats_num_lines", ["-num_lines", "character_id"]),
+    ("movies", "ix_movies_title_covering", ["title", "movie_id"], ["year", "imdb_rating", "imdb_votes"]),
+    ("movies", "ix_movies_year_covering", ["year", "movie_id"], ["title", "imdb_rating", "imdb_votes"]),
+    ("movies", "ix_movies_imdb_rating_covering", ["-imdb_rating", "movie_id"], ["title", "year", "imdb_votes"]),
+    ("movies", "ix_movies_imdb_votes_covering", ["-imdb_votes", "movie_id"], ["title", "year", "imdb_rating"]),
+]
+
+def indexes(metadata_obj):
+    """Returns the `INDEXES` as SQLAlchemy `Index` objects, built concurrently."""
+    result = []
+    for table_name, name, columns, *include in INDEXES:
+        table = metadata_obj.tables[table_name]
+        expressions = [
+            table.c[column[1:]].desc() if column.startswith("-") else table.c[column]
+            for column in columns
+        ]
+        result.append(sqlalchemy.Index(
+            name, *expressions, postgresql_include=include[0] if include else [], postgresql_concurrently=True
+        ))
+    return result
+
+
+def create_indexes(engine, metadata_obj):
+    """
+    Creates every index in `INDEXES` that does not exist yet. They are built
+    concurrently, outside a transaction, so the tables stay writable
+    meanwhile. An index left invalid by an interrupted build is dropped and
+    built again.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        invalid = set(conn.execute(sqlalchemy.text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid"
+        )).scalars())
+        for index in indexes(metadata_obj):
+            if index.name in invalid:
+                conn.execute(sqlalchemy.text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+            conn.execute(sqlalchemy.schema.CreateIndex(index, if_not_exists=True))
+
+
+# Arbitrary key of the advisory lock that serializes `setup`.
+SETUP_LOCK = 0x736368656d61
+
+
+def setup(engine, metadata_obj):
+    """
+    Creates the summary tables, `transcripts`, `changes` and the indexes if
+    needed, and fills the tables it creates. Instances started together
+    take turns, so only the first creates and clusters anything.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock:
+        lock.execute(sqlalchemy.select(sqlalchemy.func.pg_advisory_lock(SETUP_LOCK)))
+        try:
+            _setup(engine, metadata_obj)
+        finally:
+            lock.execute(sqlalchemy.select(sqlalchemy.func.pg_advisory_unlock(SETUP_LOCK)))
+
+
+def _setup(engine, metadata_obj):
+    with engine.begin() as conn:
+        tables = metadata_obj.tables
+        existing = set(sqlalchemy.inspect(conn).get_table_names())
+
+        for name in ("character_stats", "conversation_stats", "changes"):
+            tables[name].create(conn, checkfirst=True)
+        if not {"character_stats", "conversation_stats"} <= existing:
+            refresh_stats(conn, metadata_obj)
+
+        if "transcripts" not in existing:
+            tables["transcripts"].create(conn)
+            refresh_transcripts(conn, metadata_obj)
+            # New conversations get the highest ids, so rows written later are
+            # appended in key order and the table stays close to clustered.
+            conn.execute(sqlalchemy.text("CLUSTER transcripts USING transcripts_pkey"))
+            conn.execute(sqlalchemy.text("ANALYZE transcripts"))
+
+    create_indexes(engine, metadata_obj)
+
+
+def _upsert(table, key, select, columns):
+    stmt = postgresql.insert(table).from_select(columns, select)
+    return stmt.on_conflict_do_update(
+        index_elements=[key],
+        set_={column: stmt.excluded[column] for column in columns if column != key.name},
+    )
+
+
+def refresh_stats(conn, metadata_obj):
+    """Recomputes every summary row from the source tables."""
+    tables = metadata_obj.tables
+    lines = tables["lines"]
+    character_stats = tables["character_stats"]
+    conversation_stats = tables["conversation_stats"]
+
+    conn.execute(_upsert(
+        character_stats,
+        character_stats.c.character_id,
+        sqlalchemy.select(lines.c.character_id, sqlalchemy.func.count()).group_by(lines.c.character_id),
+        ["character_id", "num_lines"],
+    ))
+    conn.execute(_upsert(
+        conversation_stats,
+        conversation_stats.c.conversation_id,
+        sqlalchemy.select(lines.c.conversation_id, sqlalchemy.func.count()).group_by(lines.c.conversation_id),
+        ["conversation_id", "num_lines"],
+    ))
+
+
+def _transcript_rows(metadata_obj):
+    tables = metadata_obj.tables
+    lines = tables["lines"]
+    characters = tables["characters"]
+    return sqlalchemy.select(
+        lines.c.conversation_id,
+        lines.c.line_sort,
+        lines.c.line_id,
+        lines.c.movie_id,
+        lines.c.character_id,
+        characters.c.name,
+        lines.c.line_text,
+    ).select_from(
+        lines.outerjoin(characters, characters.c.character_id == lines.c.character_id)
+    )
+
+
+_transcript_columns = [
+    "conversation_id", "line_sort", "line_id", "movie_id", "character_id", "character_name", "line_text"
+]
+
+
+def refresh_transcripts(conn, metadata_obj):
+    """Copies every line into `transcripts`, overwriting existing rows."""
+    transcripts = metadata_obj.tables["transcripts"]
+    stmt = postgresql.insert(transcripts).from_select(
+        _transcript_columns,
+        _transcript_rows(metadata_obj).order_by(metadata_obj.tables["lines"].c.conversation_id),
+    )
+    conn.execute(stmt.on_conflict_do_update(
+        constraint="transcripts_pkey",
+        set_={column: stmt.excluded[column] for column in _transcript_columns[3:]},
+    ))
+
+
+def record_transcripts(conn, metadata_obj, conversation_ids):
+    """
+    Copies the lines of newly inserted conversations into `transcripts`.
+    Run it in the same transaction as the inserts.
+    """
+    lines = metadata_obj.tables["lines"]
+    select = _transcript_rows(metadata_obj)\
+        .where(lines.c.conversation_id.in_(conversation_ids))\
+        .order_by(lines.c.conversation_id, lines.c.line_sort)
+    conn.execute(postgresql.insert(metadata_obj.tables["transcripts"]).from_select(_transcript_columns, select))
+
+
+# Arbitrary key of the advisory lock that orders conversation writes.
+CHANGES_LOCK = 0x6368616e676573
+
+
+def lock_writes(conn):
+    """
+    Takes the lock that serializes conversation writes, held until the
+    transaction ends. Take it before reading the next conversation and
+    line ids, so concurrent writers on other workers never pick the same.
+    """
+    conn.execute(sqlalchemy.select(sqlalchemy.func.pg_advisory_xact_lock(CHANGES_LOCK)))
+
+
+def record_changes(conn, metadata_obj, written):
+    """
+    Appends a row to `changes` for each newly inserted conversation. Run it
+    in the same transaction as the inserts. The write lock is held until
+    commit, so change ids become visible in increasing order and a reader
+    that has seen id n will never later find a smaller one.
+    """
+    lock_writes(conn)
+    conn.execute(metadata_obj.tables["changes"].insert(), [
+        {"conversation_id": conv["conversation_id"], "movie_id": conv["movie_id"]}
+        for conv in written
+    ])
+
+
+def record_conversation(conn, metadata_obj, conversation_id, lines_by_character):
+    """
+    Applies a newly inserted conversation to the summary tables. Run it in
+    the same transaction as the inserts so the counts commit with them.
+    `lines_by_character` maps each participant to the lines they spoke.
+    """
+    tables = metadata_obj.tables
+    character_stats = tables["character_stats"]
+    conversation_stats = tables["conversation_stats"]
+    total = sum(lines_by_character.values())
+
+    for character_id, num_lines in lines_by_character.items():
+        stmt = postgresql.insert(character_stats).values(character_id=character_id, num_lines=num_lines)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[character_stats.c.character_id],
+            set_={"num_lines": character_stats.c.num_lines + stmt.excluded.num_lines},
+        ))
+
+    conn.execute(postgresql.insert(conversation_stats).values(
+        conversation_id=conversation_id, num_lines=total
+    ).on_conflict_do_nothing())
+
+
+if __name__ == "__main__":
+    import sys
+
+    from src import database as db
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command not in (None, "setup", "refresh"):
+        sys.exit("usage: python -m src.schema [setup|refresh]")
+    if command in (None, "setup"):
+        setup(db.engine, db.metadata_obj)
+    if command in (None, "refresh"):
+        with db.engine.begin() as conn:
+            refresh_stats(conn, db.metadata_obj)
+            refresh_transcripts(conn, db.metadata_obj)
@@ -0,0 +1,129 @@
+import functools
+import inspect
+import threading
+import typing
+from enum import Enum
+
+import anyio
+
+from src import cancellation
+from src import database as db
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.shared = cancellation.SharedTracker()
+
+
+class SingleFlight:
+    """
+    Shares one execution of a function between concurrent callers that ask
+    for the same key. The first caller runs it; everyone who arrives while
+    it is running waits and receives the same result or exception.
+
+    The shared execution's queries are only cancelled (see
+    `src.cancellation`) once every caller waiting for it has been.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        call.shared.join(cancellation.query_tracker.get())
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        token = cancellation.query_tracker.set(call.shared.tracker)
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            cancellation.query_tracker.reset(token)
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        """Same as `do`, for callers on the event loop."""
+        return await anyio.to_thread.run_sync(functools.partial(self.do, key, fn, *args, **kwargs))
+
+
+flights = SingleFlight()
+
+
+def _normalize(value):
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+def key_function(fn, key=None):
+    """
+    Returns a function mapping the arguments of a call to `fn` to a
+    hashable key. `key` is an optional function taking the handler's
+    arguments and returning the key; by default every argument is used as
+    is, with enums replaced by their values.
+    """
+    signature = inspect.signature(fn)
+
+    def make_key(args, kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        if key is not None:
+            return fn.__name__, key(**bound.arguments)
+        return fn.__name__, tuple((name, _normalize(value)) for name, value in bound.arguments.items())
+    return make_key
+
+
+def expose_signature(wrapper, fn):
+    """
+    FastAPI resolves string annotations against the wrapper's module, so
+    hand it the handler's signature with the types already resolved.
+    """
+    signature = inspect.signature(fn)
+    hints = typing.get_type_hints(fn)
+    wrapper.__signature__ = signature.replace(parameters=[
+        param.replace(annotation=hints.get(name, param.annotation))
+        for name, param in signature.parameters.items()
+    ])
+    return wrapper
+
+
+def coalesce(key=None):
+    """
+    Decorator for read handlers. Concurrent calls whose arguments normalize
+    to the same key (see `key_function`) share a single execution.
+
+    Requests that must see their own writes (`db.read_from_primary`) run
+    alone: a flight that started before their write committed could hand
+    them rows from before it.
+    """
+    def decorator(fn):
+        make_key = key_function(fn, key)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if db.read_from_primary.get():
+                return fn(*args, **kwargs)
+            return flights.do(make_key(args, kwargs), fn, *args, **kwargs)
+
+        return expose_signature(wrapper, fn)
+    return decorator
@@ -0,0 +1,292 @@
+import functools
+import re
+import threading
+from array import array
+
+import numpy as np
+import sqlalchemy
+
+from src import change_log
+from src import database as db
+
+TOKEN_RE = re.compile(r"[a-z0-9']+")
+
+
+def tokenize(text):
+    words = (token.strip("'") for token in TOKEN_RE.findall(text.lower()))
+    return [word for word in words if word]
+
+
+class TermMatrix:
+    """
+    Sparse entity x term count matrix (an entity is a movie or a character).
+
+    Each entity's row is stored twice in CSR form: once ordered by count and
+    once ordered by how distinctive each term is compared to the whole
+    corpus, so both rankings are a slice of precomputed arrays.
+
+    Lines added after the build go into a `pending` overlay of per-entity
+    counts (see `add`); rows with pending counts are ranked on the fly until
+    `compact` merges them into the arrays.
+    """
+
+    def __init__(self, rows, terms, counts):
+        self._pending = {}
+        self._build(rows, terms, counts)
+
+    def add(self, entity_id, term_id, count=1):
+        row = self._pending.setdefault(entity_id, {})
+        row[term_id] = row.get(term_id, 0) + count
+
+    def pending_row(self, entity_id):
+        """Returns a copy of the counts added to an entity since the last compaction."""
+        return dict(self._pending.get(entity_id, {}))
+
+    def compact(self):
+        """Merges the pending counts into the arrays. Call `rank_distinctive` after."""
+        rows, terms, counts = self.coo()
+        pending = [(e, t, c) for e, row in self._pending.items() for t, c in row.items()]
+        if pending:
+            p_rows, p_terms, p_counts = zip(*pending)
+            rows = np.concatenate([rows, p_rows])
+            terms = np.concatenate([terms, p_terms])
+            counts = np.concatenate([counts, p_counts])
+        self._build(rows, terms, counts)
+        self._pending = {}
+
+    def _build(self, rows, terms, counts):
+        rows = np.asarray(rows, dtype=np.int64)
+        terms = np.asarray(terms, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+
+        pairs = np.stack([rows, terms], axis=1)
+        pairs, inverse = np.unique(pairs, axis=0, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(pairs)).astype(np.int64)
+        rows, terms = pairs[:, 0], pairs[:, 1]
+
+        entity_ids = np.unique(rows)
+        row_index = np.searchsorted(entity_ids, rows)
+        indptr = np.zeros(len(entity_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_index, minlength=len(entity_ids)), out=indptr[1:])
+        row_totals = np.bincount(row_index, weights=counts, minlength=len(entity_ids)).astype(np.int64)
+
+        by_count = np.lexsort((terms, -counts, row_index))
+        self._csr = (entity_ids, indptr, row_totals, terms[by_count], counts[by_count])
+        self._rows = rows
+        self._terms = terms
+        self._counts = counts
+
+    def rank_distinctive(self, corpus_counts, corpus_total):
+        """
+        Orders every row by its smoothed log ratio of term frequency in
+        the entity to term frequency in the corpus.
+        """
+        entity_ids, indptr, row_totals, _, _ = self._csr
+        row_index = np.searchsorted(entity_ids, self._rows)
+        scores = distinctiveness(
+            self._counts, row_totals[row_index],
+            corpus_counts[self._terms], corpus_total, len(corpus_counts))
+        by_score = np.lexsort((self._terms, -scores, row_index))
+        self._distinct = (self._terms[by_score], self._counts[by_score], scores[by_score])
+
+    def row(self, entity_id):
+        """
+        Returns `(total_words, terms_by_count, counts_by_count, position)`
+        for an entity, or None if it has no words. `position` is the slice
+        of the entity's row, usable with the distinctive ordering.
+        """
+        entity_ids, indptr, row_totals, terms, counts = self._csr
+        i = np.searchsorted(entity_ids, entity_id)
+        if i == len(entity_ids) or entity_ids[i] != entity_id:
+            return None
+        start, end = indptr[i], indptr[i + 1]
+        return int(row_totals[i]), terms[start:end], counts[start:end], slice(start, end)
+
+    def distinctive(self, position):
+        """Returns the terms, counts and scores of a row slice, most distinctive first."""
+        terms, counts, scores = self._distinct
+        return terms[position], counts[position], scores[position]
+
+    def coo(self):
+        return self._rows, self._terms, self._counts
+
+
+def distinctiveness(counts, totals, corpus_counts, corpus_total, num_terms):
+    entity_freq = (counts + 1) / (totals + num_terms)
+    corpus_freq = (corpus_counts + 1) / (corpus_total + num_terms)
+    return np.log(entity_freq / corpus_freq)
+
+
+class WordIndex:
+    """
+    Word counts for every movie and every character, built in one
+    streaming pass over `lines`.
+
+    Distinctiveness is scored against the corpus counts as of the last
+    ranking, with the vocabulary size of that ranking, for built and
+    pending rows alike. The lock covers every change to the matrices and
+    the snapshot `summary` reads from them.
+    """
+
+    compact_threshold = 50000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.vocab = {}
+        self.terms = []
+        self.movies = None
+        self.characters = None
+        self._num_pending = 0
+
+    def term_id(self, word):
+        term_id = self.vocab.get(word)
+        if term_id is None:
+            term_id = self.vocab[word] = len(self.terms)
+            self.terms.append(word)
+        return term_id
+
+    def build(self, conn):
+        movie_rows, character_rows, term_ids = array("q"), array("q"), array("q")
+        result = conn.execution_options(stream_results=True, yield_per=10000).execute(
+            sqlalchemy.select(
+                db.lines.c.movie_id,
+                db.lines.c.character_id,
+                db.lines.c.line_text
+            )
+        )
+        for line in result:
+            for word in tokenize(line.line_text or ""):
+                movie_rows.append(line.movie_id)
+                character_rows.append(line.character_id)
+                term_ids.append(self.term_id(word))
+
+        ones = np.ones(len(term_ids), dtype=np.int64)
+        self.movies = TermMatrix(movie_rows, term_ids, ones)
+        self.characters = TermMatrix(character_rows, term_ids, ones)
+        self._rank()
+
+    def _rank(self):
+        _, terms, counts = self.movies.coo()
+        self.corpus_counts = np.bincount(terms, weights=counts, minlength=len(self.terms)).astype(np.int64)
+        self.corpus_total = int(self.corpus_counts.sum())
+        self.movies.rank_distinctive(self.corpus_counts, self.corpus_total)
+        self.characters.rank_distinctive(self.corpus_counts, self.corpus_total)
+
+    def add_lines(self, movie_id, lines):
+        """`lines` is a list of `(character_id, line_text)` tuples."""
+        with self._lock:
+            for character_id, line_text in lines:
+                for word in tokenize(line_text):
+                    term_id = self.term_id(word)
+                    self.movies.add(movie_id, term_id)
+                    self.characters.add(character_id, term_id)
+                    self._num_pending += 1
+            if self._num_pending >= self.compact_threshold:
+                self._compact()
+
+    def _compact(self):
+        self.movies.compact()
+        self.characters.compact()
+        self._rank()
+        self._num_pending = 0
+
+    def summary(self, matrix, entity_id, limit):
+        """
+        Returns the word statistics for one movie or character, or None if
+        it has no words.
+        """
+        with self._lock:
+            row = matrix.row(entity_id)
+            pending = matrix.pending_row(entity_id)
+            distinctive = matrix.distinctive(row[3]) if row is not None else None
+            corpus_counts, corpus_total = self.corpus_counts, self.corpus_total
+        if row is None and not pending:
+            return None
+
+        if not pending:
+            total, terms, counts, _ = row
+            top = zip(terms[:limit].tolist(), counts[:limit].tolist())
+            d_terms, d_counts, d_scores = distinctive
+            distinct = zip(d_terms[:limit].tolist(), d_counts[:limit].tolist(), d_scores[:limit].tolist())
+            unique = len(terms)
+        else:
+            # Rows with unmerged lines are small enough to rank directly.
+            merged = {} if row is None else dict(zip(row[1].tolist(), row[2].tolist()))
+            for term_id, count in pending.items():
+                merged[term_id] = merged.get(term_id, 0) + count
+            terms = np.fromiter(merged.keys(), dtype=np.int64, count=len(merged))
+            counts = np.fromiter(merged.values(), dtype=np.int64, count=len(merged))
+            total = int(counts.sum())
+            term_corpus_counts = np.zeros(len(terms), dtype=np.int64)
+            known = terms < len(corpus_counts)
+            term_corpus_counts[known] = corpus_counts[terms[known]]
+            scores = distinctiveness(counts, total, term_corpus_counts, corpus_total, len(corpus_counts))
+            by_count = np.lexsort((terms, -counts))[:limit]
+            by_score = np.lexsort((terms, -scores))[:limit]
+            top = zip(terms[by_count].tolist(), counts[by_count].tolist())
+            distinct = zip(terms[by_score].tolist(), counts[by_score].tolist(), scores[by_score].tolist())
+            unique = len(terms)
+
+        return {
+            "total_words": total,
+            "unique_words": unique,
+            "top_words": [
+                {"word": self.terms[term_id], "count": count}
+                for term_id, count in top
+            ],
+            "distinctive_words": [
+                {"word": self.terms[term_id], "count": count, "score": round(score, 4)}
+                for term_id, count, score in distinct
+            ],
+        }
+
+
+def apply_changes(index, conn, changes):
+    """Adds the lines of the conversations in new `changes` rows to `index`."""
+    lines = conn.execute(
+        sqlalchemy.select(db.lines.c.movie_id, db.lines.c.character_id, db.lines.c.line_text)
+        .where(db.lines.c.conversation_id.in_([change.conversation_id for change in changes]))
+        .order_by(db.lines.c.conversation_id, db.lines.c.line_sort)
+    ).fetchall()
+    by_movie = {}
+    for line in lines:
+        by_movie.setdefault(line.movie_id, []).append((line.character_id, line.line_text or ""))
+    for movie_id, movie_lines in by_movie.items():
+        index.add_lines(movie_id, movie_lines)
+
+
+def build_index(conn):
+    index = WordIndex()
+    index.build(conn)
+    return index
+
+
+_index = None
+_follower = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Returns the process-wide word index, building it on first use. Lines
+    committed while it builds, here or on other workers, are applied from
+    the `changes` log afterwards (see `src.change_log`).
+    """
+    global _index, _follower
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index, last_change = change_log.build_at_snapshot(build_index)
+                _follower = change_log.ChangeFollower(
+                    last_change, functools.partial(apply_changes, index), change_log.SYNC_INTERVAL)
+                _follower.sync()
+                _index = index
+    else:
+        _follower.sync_if_due()
+    return _index
+
+
+def sync():
+    """Applies newly committed lines to the word index if it is loaded."""
+    if _follower is not None:
+        _follower.sync()
@@ -0,0 +1,9 @@
+import pytest
+
+from src import database as db
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    """Creates the tables the app adds to the source schema, as a deploy would."""
+    db.ensure_schema()
@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+import pytest
+import sqlalchemy
+from fastapi import HTTPException
+
+from src import database as db
+from src.admission import RouteClass
+
+
+def test_queue_full_is_rejected_with_429():
+    async def scenario():
+        route_class = RouteClass("test", max_concurrent=1, max_queue=1, queue_timeout=1.0, statement_timeout_ms=0)
+        await route_class.acquire()
+        waiter = asyncio.ensure_future(route_class.acquire())
+        await asyncio.sleep(0)
+
+        with pytest.raises(HTTPException) as e:
+            await route_class.acquire()
+        assert e.value.status_code == 429
+
+        route_class.release()
+        await waiter
+        route_class.release()
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_is_rejected_with_503():
+    async def scenario():
+        route_class = RouteClass("test", max_concurrent=1, max_queue=5, queue_timeout=0.01, statement_timeout_ms=0)
+        await route_class.acquire()
+
+        with pytest.raises(HTTPException) as e:
+            await route_class.acquire()
+        assert e.value.status_code == 503
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_keep_its_permit():
+    async def scenario():
+        route_class = RouteClass("test", max_concurrent=1, max_queue=5, queue_timeout=1.0, statement_timeout_ms=0)
+        await route_class.acquire()
+        waiter = asyncio.ensure_future(route_class.acquire())
+        await asyncio.sleep(0.01)
+
+        # The permit is handed to the waiter, which is cancelled before it
+        # gets to run.
+        route_class.release()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+        await route_class.acquire()
+        route_class.release()
+
+    asyncio.run(scenario())
+
+
+def test_request_deadline_uses_shortest_timeout():
+    from starlette.requests import Request
+    from src.admission import request_deadline
+
+    def request(headers):
+        return Request({"type": "http", "headers": [(k.encode(), v.encode()) for k, v in headers.items()]})
+
+    route_class = RouteClass("test", 1, 1, 1.0, 0, deadline=5.0)
+    now = time.monotonic()
+    assert 4 < request_deadline(request({}), route_class) - now <= 5.1
+    assert request_deadline(request({"x-request-timeout": "0.5"}), route_class) - now <= 0.6
+    assert request_deadline(request({"x-request-timeout": "60"}), route_class) - now <= 5.1
+    assert 4 < request_deadline(request({"x-request-timeout": "soon"}), route_class) - now <= 5.1
+    assert request_deadline(request({}), RouteClass("test", 1, 1, 1.0, 0)) is None
+    for header in ["inf", "-inf", "nan"]:
+        assert request_deadline(request({"x-request-timeout": header}), RouteClass("test", 1, 1, 1.0, 0)) is None
+
+
+def test_statement_timeout_is_kept_across_checkouts():
+    token = db.statement_timeout.set(1234)
+    try:
+        for _ in range(2):
+            with db.engine.connect() as conn:
+                assert conn.execute(sqlalchemy.text("SHOW statement_timeout")).scalar() == "1234ms"
+                conn.rollback()
+                assert conn.execute(sqlalchemy.text("SHOW statement_timeout")).scalar() == "1234ms"
+        with db.unbounded(), db.engine.connect() as conn:
+            assert conn.execute(sqlalchemy.text("SHOW statement_timeout")).scalar() == "0"
+    finally:
+        db.statement_timeout.reset(token)
@@ -0,0 +1,61 @@
+import functools
+
+from fastapi.testclient import TestClient
+
+from src import autocomplete
+from src import change_log
+from src.api.server import app
+from src.autocomplete import PrefixIndex, normalize
+
+
+def make_index():
+    return PrefixIndex([
+        (1, "Star Wars", 100),
+        (2, "Starman", 300),
+        (3, "The Lost Star", 200),
+        (4, "Amélie", 50),
+        (5, "Wall-E", None),
+    ])
+
+
+def test_normalize():
+    assert normalize("  Amélie's  WALL-E!") == "amelies wall e"
+
+
+def test_prefix_matches_any_word_ranked_by_score():
+    index = make_index()
+    assert index.search("star", 10) == [(2, 300), (3, 200), (1, 100)]
+    assert index.search("STAR", 2) == [(2, 300), (3, 200)]
+    assert index.search("star w", 10) == [(1, 100)]
+    assert index.search("wa", 10) == [(1, 100), (5, 0)]
+    assert index.search("ameli", 10) == [(4, 50)]
+    assert index.search("zzz", 10) == []
+    assert index.search("!!", 10) == []
+
+
+def test_add_score_reorders():
+    index = make_index()
+    index.add_score(1, 250)
+    assert index.search("star", 1) == [(1, 350)]
+    index.add_score(42, 1)
+
+
+def test_ranking_follows_other_workers():
+    # An index built before the post stands in for another worker's.
+    other, last_change = change_log.build_at_snapshot(autocomplete.build_index)
+    follower = change_log.ChangeFollower(last_change, functools.partial(autocomplete.apply_changes, other), 0)
+
+    def num_lines():
+        return dict(other.characters.search("colonel anderson", 100))[7421]
+
+    before = num_lines()
+    TestClient(app).post("/movies/502/conversations/", json={
+        "character_1_id": 7421,
+        "character_2_id": 7423,
+        "lines": [
+            {"character_id": 7421, "line_text": "Autocomplete sync test"},
+            {"character_id": 7421, "line_text": "Autocomplete sync test"},
+        ],
+    })
+    follower.sync()
+    assert num_lines() == before + 2
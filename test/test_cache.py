@@ -0,0 +1,136 @@
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from src import cache
+from src import database as db
+from src.api.server import app
+from src.cache import LRU, MmapStore, TwoLevelCache, decode, encode
+
+client = TestClient(app)
+
+
+def test_encode_round_trip():
+    small = b'{"movie_id": 1}'
+    large = b'{"lines": [' + b'"the same line", ' * 500 + b'""]}'
+    assert decode(encode(200, small)) == (200, small)
+    assert decode(encode(200, large)) == (200, large)
+    assert len(encode(200, large)) < len(large) // 10
+
+
+def test_lru_evicts_least_recently_used():
+    lru = LRU(2)
+    lru.set("a", 1, 60)
+    lru.set("b", 2, 60)
+    lru.get("a")
+    lru.set("c", 3, 60)
+    assert (lru.get("a"), lru.get("b"), lru.get("c")) == (1, None, 3)
+
+
+def test_shared_tier_warms_other_processes_until_invalidated(tmp_path):
+    # Two caches over the same directory stand in for two workers.
+    first = TwoLevelCache(MmapStore(str(tmp_path)))
+    second = TwoLevelCache(MmapStore(str(tmp_path)))
+
+    assert first.get_or_load("key", lambda: b"old") == b"old"
+    assert second.get_or_load("key", lambda: b"unused") == b"old"
+
+    second.invalidate()
+    assert first.get_or_load("key", lambda: b"new") == b"new"
+    assert second.get_or_load("key", lambda: b"unused") == b"new"
+    assert [p.name for p in tmp_path.iterdir() if p.name.isdigit()] == ["1"]
+
+
+class FlakyStore(MmapStore):
+    down = False
+
+    def bump_version(self):
+        if self.down:
+            raise OSError("shared tier down")
+        return super().bump_version()
+
+
+def test_failed_invalidation_bypasses_cache_until_retried(tmp_path):
+    store = FlakyStore(str(tmp_path))
+    responses = TwoLevelCache(store)
+    assert responses.get_or_load("key", lambda: b"old") == b"old"
+
+    store.down = True
+    with pytest.raises(OSError):
+        responses.invalidate()
+    assert responses.get_or_load("key", lambda: b"uncached") == b"uncached"
+
+    store.down = False
+    assert responses.get_or_load("key", lambda: b"new") == b"new"
+    assert responses.get_or_load("key", lambda: b"unused") == b"new"
+
+
+def test_concurrent_misses_load_once(tmp_path):
+    responses = TwoLevelCache(MmapStore(str(tmp_path)))
+    calls = []
+
+    def slow_load():
+        calls.append(1)
+        time.sleep(0.2)
+        return b"result"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(responses.get_or_load("key", slow_load)))
+        for _ in range(10)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [b"result"] * 10
+
+
+def test_cached_endpoint(tmp_path, monkeypatch):
+    uncached = client.get("/movies/?limit=5&sort=votes").json()
+    monkeypatch.setattr(cache, "response_cache", TwoLevelCache(MmapStore(str(tmp_path))))
+
+    assert client.get("/movies/?limit=5&sort=votes").json() == uncached
+    assert len(cache.response_cache.local) == 1
+    assert client.get("/movies/?limit=5&sort=votes").json() == uncached
+    assert len(cache.response_cache.local) == 1
+    assert client.get("/movies/999999").status_code == 404
+    assert len(cache.response_cache.local) == 1
+
+
+def test_misses_are_filled_from_primary_after_syncing(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "response_cache", TwoLevelCache(MmapStore(str(tmp_path))))
+    calls = []
+    monkeypatch.setattr(cache.graph, "sync", lambda: calls.append("graph"))
+    monkeypatch.setattr(cache.words, "sync", lambda: calls.append("words"))
+
+    @cache.cached()
+    def handler(movie_id: int):
+        calls.append(("load", db.read_from_primary.get()))
+        return {"movie_id": movie_id}
+
+    assert handler(1).body == b'{"movie_id":1}'
+    assert handler(1).body == b'{"movie_id":1}'
+    assert calls == ["graph", "words", ("load", True)]
+
+
+def test_uncached_handlers_are_coalesced(monkeypatch):
+    monkeypatch.setattr(cache, "response_cache", None)
+    calls = []
+
+    @cache.cached()
+    def handler(movie_id: int):
+        calls.append(movie_id)
+        time.sleep(0.2)
+        return {"movie_id": movie_id}
+
+    threads = [threading.Thread(target=handler, args=(1,)) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert calls == [1]
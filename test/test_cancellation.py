@@ -0,0 +1,51 @@
+import pytest
+
+from src.cancellation import QueryTracker, RequestAbandoned, SharedTracker, cancelled_connections
+
+
+class FakeConnection:
+    def __init__(self):
+        self.cancels = 0
+
+    def cancel(self):
+        self.cancels += 1
+
+
+def test_cancel_running_queries():
+    tracker = QueryTracker()
+    running, returned = FakeConnection(), FakeConnection()
+    tracker.add(running)
+    tracker.add(returned)
+    tracker.discard(returned)
+
+    tracker.cancel()
+    tracker.cancel()
+    assert running.cancels == 1
+    assert returned.cancels == 0
+    assert running in cancelled_connections
+
+    with pytest.raises(RequestAbandoned):
+        tracker.add(FakeConnection())
+
+
+def test_shared_tracker_waits_for_every_owner():
+    shared = SharedTracker()
+    connection = FakeConnection()
+    shared.tracker.add(connection)
+    first, second = QueryTracker(), QueryTracker()
+    shared.join(first)
+    shared.join(second)
+
+    first.cancel()
+    assert connection.cancels == 0
+    second.cancel()
+    assert connection.cancels == 1
+
+
+def test_shared_tracker_kept_alive_without_owner_tracker():
+    shared = SharedTracker()
+    owner = QueryTracker()
+    shared.join(owner)
+    shared.join(None)
+    owner.cancel()
+    assert not shared.tracker.cancelled
@@ -63,3 +63,39 @@ def test_sort_filter2():
 def test_404():
     response = client.get("/characters/400")
     assert response.status_code == 404
+
+
+def test_get_characters_batch():
+    response = client.get("/characters/batch?ids=7421&ids=400&ids=2")
+    assert response.status_code == 200
+
+    with open(prefix + "test/characters/7421.json", encoding="utf-8") as f1, \
+            open(prefix + "test/characters/2.json", encoding="utf-8") as f2:
+        assert response.json() == [json.load(f1), json.load(f2)]
+
+
+def test_top_partners():
+    response = client.get("/characters/7421/top_partners?k=1")
+    assert response.status_code == 200
+
+    with open(prefix + "test/characters/7421.json", encoding="utf-8") as f:
+        assert response.json() == json.load(f)["top_conversations"][:1]
+
+
+def test_interaction_path():
+    response = client.get("/characters/7421/path/7423")
+    assert response.status_code == 200
+    assert [x["character_id"] for x in response.json()] == [7421, 7423]
+
+
+def test_min_lines_and_gender_filters():
+    response = client.get("/characters/?min_lines=10&gender=female&sort=number_of_lines&limit=250")
+    assert response.status_code == 200
+    rows = response.json()
+    assert rows
+    assert all(row["number_of_lines"] >= 10 for row in rows)
+    assert [row["number_of_lines"] for row in rows] == sorted((row["number_of_lines"] for row in rows), reverse=True)
+
+    for row in rows[:5]:
+        character = client.get(f"/characters/{row['character_id']}").json()
+        assert character["gender"].lower() == "f"
@@ -2,10 +2,14 @@ import unittest
 
 from fastapi.testclient import TestClient
 
+from src import change_log
+from src import graph
 from src.api.server import app
-from src.api.conversations import add_conversation, LinesJson, ConversationJson
+from src.api.conversations import add_conversation, write_batch, LinesJson, ConversationJson
 from fastapi import HTTPException
+import functools
 import random
+import threading
 
 
 client = TestClient(app)
@@ -53,6 +57,108 @@ class TestAddConversation(unittest.TestCase):
         assert rand1 in [x.get("line_text") for x in response_0]
         assert rand2 in [x.get("line_text") for x in response_1]
 
+    def test_stats_updated(self):
+        def num_lines():
+            response = client.get("/characters/?name=colonel anderson").json()
+            return [x for x in response if x["character_id"] == 7421][0]["number_of_lines"]
+
+        before = num_lines()
+        conversation = ConversationJson(
+            character_1_id=7421,
+            character_2_id=7423,
+            lines=[
+                LinesJson(character_id=7421, line_text="Stats test line one"),
+                LinesJson(character_id=7423, line_text="Stats test line two"),
+                LinesJson(character_id=7421, line_text="Stats test line three")
+            ]
+        )
+        add_conversation(502, conversation)
+        assert num_lines() == before + 2
+
+    def test_transcript(self):
+        conversation = ConversationJson(
+            character_1_id=7421,
+            character_2_id=7423,
+            lines=[
+                LinesJson(character_id=7421, line_text="Transcript test one"),
+                LinesJson(character_id=7423, line_text="Transcript test two"),
+            ]
+        )
+        conversation_id = add_conversation(502, conversation)
+
+        response = client.get(f"/conversations/{conversation_id}")
+        assert response.status_code == 200
+        transcript = response.json()
+        assert transcript["movie_id"] == 502
+        assert [(x["line_sort"], x["character_id"], x["line_text"]) for x in transcript["lines"]] == [
+            (1, 7421, "Transcript test one"),
+            (2, 7423, "Transcript test two"),
+        ]
+
+        listing = client.get("/movies/502/conversations?limit=50").json()
+        assert all(x["movie_id"] == 502 for x in listing)
+        assert [x["conversation_id"] for x in listing] == sorted(x["conversation_id"] for x in listing)
+
+    def test_changes_feed(self):
+        latest = client.get("/changes?limit=1").json()["latest"]
+        conversation = ConversationJson(
+            character_1_id=7421,
+            character_2_id=7423,
+            lines=[
+                LinesJson(character_id=7421, line_text="Change feed test one"),
+                LinesJson(character_id=7423, line_text="Change feed test two"),
+            ]
+        )
+        conversation_id = add_conversation(502, conversation)
+
+        feed = client.get(f"/changes?since={latest}").json()
+        assert feed["latest"] > latest
+        assert feed["next"] == feed["latest"]
+        change = [x for x in feed["changes"] if x["conversation"]["conversation_id"] == conversation_id][0]
+        assert change["token"] > latest
+        assert [x["line_text"] for x in change["lines"]] == ["Change feed test one", "Change feed test two"]
+
+        assert client.get(f"/changes?since={feed['next']}").json()["changes"] == []
+
+    def test_graph_follows_other_workers(self):
+        # A graph built before the post stands in for another worker's.
+        other, last_change = change_log.build_at_snapshot(graph.build_graph)
+        follower = change_log.ChangeFollower(last_change, functools.partial(graph.apply_changes, other), 0)
+        before = dict(other.neighbors(7421)).get(7423, 0)
+
+        add_conversation(502, ConversationJson(
+            character_1_id=7421,
+            character_2_id=7423,
+            lines=[LinesJson(character_id=7421, line_text="Graph sync test")],
+        ))
+        follower.sync()
+        assert dict(other.neighbors(7421))[7423] == before + 1
+        follower.sync()
+        assert dict(other.neighbors(7421))[7423] == before + 1
+
+    def test_concurrent_writers_get_distinct_ids(self):
+        # Each thread commits on its own connection, like separate workers.
+        conversation = ConversationJson(
+            character_1_id=7421,
+            character_2_id=7423,
+            lines=[LinesJson(character_id=7421, line_text="Concurrent write test")],
+        )
+        written, errors = [], []
+
+        def write():
+            try:
+                written.extend(write_batch([(502, conversation)]))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert len({conv["conversation_id"] for conv in written}) == 8
+
     # Error tests
     def test_chars_not_found(self):
         conversation = ConversationJson(
@@ -89,3 +195,8 @@ class TestAddConversation(unittest.TestCase):
         )
         with self.assertRaises(HTTPException):
             add_conversation(3, conversation)
+
+
+class TestTranscripts(unittest.TestCase):
+    def test_transcript_not_found(self):
+        assert client.get("/conversations/-1").status_code == 404
@@ -0,0 +1,63 @@
+import functools
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+from src import change_log
+from src import dialogue_stats
+from src.api.server import app
+from src.dialogue_stats import aggregate, group_quantiles
+
+
+def make_columns():
+    # Movie 10: characters 1 (m) and 2 (f) in conversations 100 (3 lines)
+    # and 101 (1 line). Movie 20: character 3 (unknown gender) and a
+    # conversation without lines. Movie 30 has nothing.
+    return {
+        "line_movies": np.array([10, 10, 10, 10, 20]),
+        "line_characters": np.array([1, 2, 1, 1, 3]),
+        "line_conversations": np.array([100, 100, 100, 101, 200]),
+        "line_words": np.array([2, 3, 4, 1, 5]),
+        "character_ids": np.array([2, 1, 3]),
+        "character_genders": np.array([1, 0, 2]),
+        "conversation_ids": np.array([101, 100, 200, 201]),
+        "conversation_movies": np.array([10, 10, 20, 20]),
+    }
+
+
+def test_group_quantiles():
+    groups = np.array([0, 0, 0, 2])
+    values = np.array([5, 1, 3, 7])
+    median, maximum = group_quantiles(groups, values, 3, (0.5, 1.0))
+    assert median.tolist() == [3, 0, 7]
+    assert maximum.tolist() == [5, 0, 7]
+
+
+def test_aggregate():
+    stats = aggregate(np.array([10, 20, 30]), make_columns())
+    assert stats["num_lines"].tolist() == [4, 1, 0]
+    assert stats["num_words"].tolist() == [10, 5, 0]
+    assert stats["num_characters"].tolist() == [2, 1, 0]
+    assert stats["num_conversations"].tolist() == [2, 1, 0]
+    assert stats["lines_per_character_mean"].tolist() == [2.0, 1.0, 0.0]
+    assert stats["lines_per_character_max"].tolist() == [3, 1, 0]
+    assert stats["words_per_character_max"].tolist() == [7, 5, 0]
+    assert stats["gender_lines"].tolist() == [[3, 1, 0], [0, 0, 1], [0, 0, 0]]
+    assert stats["conversation_length_max"].tolist() == [3, 1, 0]
+    assert stats["conversation_length_histogram"][0].tolist() == [1, 1, 0, 0, 0]
+    assert stats["top5_share"].tolist() == [1.0, 1.0, 0.0]
+
+
+def test_stats_follow_other_workers():
+    # Statistics built before the post stand in for another worker's.
+    other, last_change = change_log.build_at_snapshot(dialogue_stats.build_stats)
+    follower = change_log.ChangeFollower(last_change, functools.partial(dialogue_stats.apply_changes, other), 0)
+    before = other.movie(502)["num_conversations"]
+
+    TestClient(app).post("/movies/502/conversations/", json={
+        "character_1_id": 7421,
+        "character_2_id": 7423,
+        "lines": [{"character_id": 7421, "line_text": "Stats sync test"}],
+    })
+    follower.sync()
+    assert other.movie(502)["num_conversations"] == before + 1
@@ -0,0 +1,33 @@
+from fastapi.testclient import TestClient
+
+from src.api.server import app
+
+import csv
+import io
+import json
+
+client = TestClient(app)
+
+
+def test_export_csv():
+    response = client.get("/export/characters?format=csv&movie_id=436")
+    assert response.status_code == 200
+
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert len(rows) > 0
+    assert all(row["movie_id"] == "436" for row in rows)
+    assert "6563" in [row["character_id"] for row in rows]
+
+
+def test_export_ndjson():
+    response = client.get("/export/movies?format=ndjson")
+    assert response.status_code == 200
+
+    movies = [json.loads(line) for line in response.text.splitlines()]
+    assert {"movie_id": 44}.items() <= movies[[m["movie_id"] for m in movies].index(44)].items()
+    assert [m["movie_id"] for m in movies] == sorted(m["movie_id"] for m in movies)
+
+
+def test_export_ignores_infinite_request_timeout():
+    response = client.get("/export/movies?format=ndjson", headers={"X-Request-Timeout": "inf"})
+    assert response.status_code == 200
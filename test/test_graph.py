@@ -0,0 +1,35 @@
+from src.graph import InteractionGraph
+
+
+def make_graph():
+    # 1 -- 2 -- 3, with 5 + 1 lines between 1 and 2 and 7 between 2 and 3
+    return InteractionGraph(
+        [1, 2, 1, 2, 2, 3],
+        [2, 1, 2, 1, 3, 2],
+        [5, 5, 1, 1, 7, 7],
+        {1: 0, 2: 0, 3: 0},
+    )
+
+
+def test_neighbors_sorted_by_weight():
+    g = make_graph()
+    assert g.neighbors(2) == [(3, 7), (1, 6)]
+    assert g.top_partners(2, 1) == [(3, 7)]
+    assert g.neighbors(42) == []
+
+
+def test_shortest_path():
+    g = make_graph()
+    assert g.shortest_path(1, 3) == [1, 2, 3]
+    assert g.shortest_path(1, 42) is None
+
+
+def test_add_conversation_before_and_after_compaction():
+    g = make_graph()
+    g.add_conversation(3, 4, 0, 2)
+    assert g.neighbors(3) == [(2, 7), (4, 2)]
+    assert g.shortest_path(1, 4) == [1, 2, 3, 4]
+
+    g._compact()
+    assert g.neighbors(3) == [(2, 7), (4, 2)]
+    assert g.neighbors(4) == [(3, 2)]
@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+from src.group_commit import GroupCommitter
+
+
+def run_concurrently(writer, items):
+    results = {}
+
+    def submit(item):
+        try:
+            results[item] = writer.submit(item)
+        except ValueError as e:
+            results[item] = e
+
+    threads = [threading.Thread(target=submit, args=(item,)) for item in items]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_items_are_batched():
+    batches = []
+
+    def flush(items):
+        batches.append(items)
+        return [item * 10 for item in items]
+
+    writer = GroupCommitter(flush, max_batch=50, max_delay=0.05)
+    results = run_concurrently(writer, range(20))
+
+    assert results == {item: item * 10 for item in range(20)}
+    assert len(batches) < 20
+
+
+def test_failed_item_only_fails_its_caller():
+    def flush(items):
+        if 3 in items:
+            raise ValueError("bad item")
+        return items
+
+    writer = GroupCommitter(flush, max_batch=50, max_delay=0.05)
+    results = run_concurrently(writer, range(6))
+
+    assert isinstance(results.pop(3), ValueError)
+    assert results == {item: item for item in range(6) if item != 3}
+
+    with pytest.raises(ValueError):
+        writer.submit(3)
+
+
+def test_after_commit_errors_do_not_retry_committed_items():
+    flushed = []
+
+    def flush(items):
+        flushed.extend(items)
+        return items
+
+    def after_commit(results):
+        raise RuntimeError("index update failed")
+
+    writer = GroupCommitter(flush, after_commit=after_commit, max_batch=50, max_delay=0.05)
+    results = run_concurrently(writer, range(6))
+
+    assert results == {item: item for item in range(6)}
+    assert sorted(flushed) == list(range(6))
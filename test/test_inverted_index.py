@@ -0,0 +1,154 @@
+import functools
+import threading
+
+import numpy as np
+import sqlalchemy
+from fastapi.testclient import TestClient
+
+from src import change_log
+from src import database as db
+from src import inverted_index
+from src.api.server import app
+from src.inverted_index import LineIndex, highlight, top
+
+
+def make_index():
+    index = LineIndex()
+    index.movie_years = {1: 1999, 2: 1975}
+    texts = [
+        (1, 10, "I love you."),
+        (1, 11, "You love me? I love you, you fool."),
+        (2, 20, "Love is a battlefield."),
+        (2, 21, "Nobody here."),
+    ]
+    index.add_lines([
+        {"line_id": i, "movie_id": m, "character_id": c, "conversation_id": 0, "line_text": t}
+        for i, (m, c, t) in enumerate(texts)
+    ])
+    return index
+
+
+def test_ranked_by_bm25():
+    index = make_index()
+    total, hits = index.search("love you")
+    assert total == 3
+    assert [doc for doc, _ in hits][-1] == 2
+    assert all(a[1] >= b[1] for a, b in zip(hits, hits[1:]))
+
+
+def test_phrase_and_filters():
+    index = make_index()
+    assert [doc for doc, _ in index.search('"love you"')[1]] == [1, 0]
+    assert [doc for doc, _ in index.search('"you love"')[1]] == [1]
+    assert [doc for doc, _ in index.search("love", year_max=1980)[1]] == [2]
+    assert [doc for doc, _ in index.search("love", character_id=10)[1]] == [0]
+    assert index.search("missing") == (0, [])
+
+
+def test_build_matches_added_lines():
+    built, added = LineIndex(), LineIndex()
+    with db.engine.connect() as conn:
+        built.build(conn)
+        added.movie_years = built.movie_years
+        added.add_lines([
+            row._asdict() for row in conn.execute(
+                sqlalchemy.select(db.lines).where(db.lines.c.line_text.is_not(None)).order_by(db.lines.c.line_id)
+            )
+        ])
+
+    assert built.line_ids.view().tolist() == added.line_ids.view().tolist()
+    for query in ["love", "i love you", '"i love"', "the man", '"what do you"']:
+        assert built.search(query, limit=50) == added.search(query, limit=50)
+        assert built.search(query, limit=10, offset=5) == added.search(query, limit=10, offset=5)
+
+
+def test_compact_keeps_results():
+    index = make_index()
+    queries = ["love you", '"love you"', "love"]
+    before = [index.search(q) for q in queries]
+    index._compact()
+    assert index._snapshot[1] == {}
+    assert [index.search(q) for q in queries] == before
+
+    index.compact_threshold = 1
+    index.add_lines([{"line_id": 4, "movie_id": 1, "character_id": 10, "conversation_id": 0, "line_text": "love"}])
+    assert index._snapshot[1] == {}
+    assert [doc for doc, _ in index.search("love", character_id=10)[1]] == [4, 0]
+
+
+def test_year_max_excludes_unknown_years():
+    index = make_index()
+    index.add_lines([{"line_id": 4, "movie_id": 3, "character_id": 30, "conversation_id": 0, "line_text": "love"}])
+    assert [doc for doc, _ in index.search("love", year_max=1980)[1]] == [2]
+    assert 4 in [doc for doc, _ in index.search("love")[1]]
+
+
+def test_search_during_compaction_counts_lines_once():
+    index = LineIndex()
+    index.compact_threshold = 20
+    added = [0]
+    totals = []
+    done = threading.Event()
+
+    def search():
+        while not done.is_set():
+            totals.append((index.search("compact")[0], added[0]))
+
+    searcher = threading.Thread(target=search)
+    searcher.start()
+    for i in range(2000):
+        index.add_lines([{"line_id": i, "movie_id": 1, "character_id": 1, "conversation_id": 0,
+                          "line_text": "compact me"}])
+        added[0] += 1
+    done.set()
+    searcher.join()
+
+    assert index.search("compact")[0] == 2000
+    # The line being added may already be searchable; a line counted in
+    # both the merged postings and the old overlay would overshoot more.
+    assert all(total <= added_after + 1 for total, added_after in totals)
+
+
+def test_top_breaks_ties_by_line():
+    rng = np.random.default_rng(0)
+    docs = np.arange(1000)
+    scores = rng.integers(0, 20, 1000).astype(float)
+    order = np.lexsort((docs, -scores))
+    for k in [0, 1, 7, 50, 999, 1000, 2000]:
+        assert top(docs, scores, k).tolist() == order[:k].tolist()
+
+
+def test_highlight():
+    assert highlight("I love you.", "LOVE") == "I <mark>love</mark> you."
+    assert highlight("<b>love</b> & you", "love") == "&lt;b&gt;<mark>love</mark>&lt;/b&gt; &amp; you"
+
+
+def test_search_escapes_posted_lines():
+    client = TestClient(app)
+    response = client.post("/movies/502/conversations/", json={
+        "character_1_id": 7421,
+        "character_2_id": 7423,
+        "lines": [{"character_id": 7421, "line_text": "<script>alert(1)</script> xsscanary"}],
+    })
+    assert response.status_code == 200
+
+    results = client.get("/search/lines?q=xsscanary&limit=100").json()["results"]
+    [snippet] = [r["snippet"] for r in results if r["conv_id"] == response.json()]
+    assert snippet == "&lt;script&gt;alert(1)&lt;/script&gt; <mark>xsscanary</mark>"
+
+
+def test_index_follows_other_workers():
+    # An index built before the post stands in for another worker's.
+    other, last_change = change_log.build_at_snapshot(inverted_index.build_index)
+    follower = change_log.ChangeFollower(last_change, functools.partial(inverted_index.apply_changes, other), 0)
+    before = other.search("followcanary")[0]
+
+    TestClient(app).post("/movies/502/conversations/", json={
+        "character_1_id": 7421,
+        "character_2_id": 7423,
+        "lines": [{"character_id": 7423, "line_text": "followcanary"}],
+    })
+    follower.sync()
+    assert other.search("followcanary")[0] == before + 1
+    follower.sync()
+    assert other.search("followcanary")[0] == before + 1
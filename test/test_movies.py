@@ -49,3 +49,44 @@ def test_sort_filter():
 def test_404():
     response = client.get("/movies/1")
     assert response.status_code == 404
+
+
+def test_get_movies_batch():
+    response = client.get("/movies/batch?ids=436&ids=1&ids=44")
+    assert response.status_code == 200
+
+    with open(prefix + "test/movies/436.json", encoding="utf-8") as f1, \
+            open(prefix + "test/movies/44.json", encoding="utf-8") as f2:
+        assert response.json() == [json.load(f1), json.load(f2)]
+
+
+def test_get_movie_words():
+    response = client.get("/movies/44/words?limit=10")
+    assert response.status_code == 200
+
+    summary = response.json()
+    assert summary["movie_id"] == 44
+    assert len(summary["top_words"]) == 10
+    counts = [x["count"] for x in summary["top_words"]]
+    assert counts == sorted(counts, reverse=True)
+    assert sum(counts) <= summary["total_words"]
+
+
+def test_columnar_format():
+    rows = client.get("/movies/?limit=10&sort=rating").json()
+    columns = client.get("/movies/?limit=10&sort=rating&format=columnar").json()
+    assert columns == {key: [row[key] for row in rows] for key in rows[0]}
+
+
+def test_range_filters_and_combined_sort():
+    response = client.get("/movies/?year_min=1990&year_max=1999&rating_min=7&sort=year&sort=rating&limit=250")
+    assert response.status_code == 200
+    rows = response.json()
+    assert rows
+    assert all("1990" <= str(row["year"])[:4] <= "1999" and row["imdb_rating"] >= 7 for row in rows)
+    keys = [(str(row["year"]), -row["imdb_rating"]) for row in rows]
+    assert keys == sorted(keys)
+
+    response = client.get("/movies/?votes_min=50000&sort=votes")
+    votes = [row["imdb_votes"] for row in response.json()]
+    assert votes and all(v >= 50000 for v in votes) and votes == sorted(votes, reverse=True)
@@ -0,0 +1,112 @@
+"""
+Query plan regression tests. Every statement a route runs is captured and
+EXPLAINed with sequential scans disabled, so a plan that still scans a
+large table has no index it can use. Plans must also stay under a cost
+budget. Run against a seeded database.
+
+Each route is requested once before capturing, so the one-off full reads
+that build the in-memory indexes (`src.graph`, `src.words`) are not
+checked.
+"""
+from contextlib import contextmanager
+
+import pytest
+import sqlalchemy
+from fastapi.testclient import TestClient
+
+from src import database as db
+from src.api.server import app
+
+client = TestClient(app)
+
+LARGE_TABLES = {"lines", "conversations", "characters"}
+
+# Planner cost units; with sequential scans disabled a seq scan alone costs
+# more than this.
+COST_BUDGET = 200000
+
+PATHS = [
+    "/movies/0",
+    "/movies/batch?ids=0&ids=1",
+    "/movies/?limit=50",
+    "/movies/?sort=year",
+    "/movies/?sort=rating",
+    # Least and most selective filter combinations.
+    "/movies/?year_min=1900&rating_min=0&votes_min=0&sort=year&sort=rating",
+    "/movies/?year_min=1999&year_max=1999&rating_min=8&votes_min=100000&sort=votes",
+    "/characters/0",
+    "/characters/batch?ids=0&ids=1",
+    "/characters/?limit=50",
+    "/characters/?sort=movie",
+    "/characters/?sort=number_of_lines",
+    "/characters/?min_lines=1&sort=number_of_lines",
+    "/characters/?min_lines=100&gender=female",
+    "/characters/?gender=unknown&sort=movie",
+    "/lines/0",
+    "/lines/?token=the",
+    "/lines_spoken_to/?id=0",
+    "/conversations/0",
+    "/movies/0/conversations",
+    "/changes?since=0",
+]
+
+# Large tables a route reads in full by design.
+EXEMPT = {
+    # Substring matches on line text cannot use a btree index.
+    "/lines/?token=the": {"lines"},
+}
+
+
+@contextmanager
+def captured_statements():
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            statements.append((statement, parameters))
+
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", capture)
+    try:
+        yield statements
+    finally:
+        sqlalchemy.event.remove(db.engine, "before_cursor_execute", capture)
+
+
+def explain(statement, parameters):
+    raw = db.engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        # Local to the transaction rolled back below, so the pooled
+        # connection never keeps it, even when EXPLAIN fails.
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        return cursor.fetchone()[0][0]["Plan"]
+    finally:
+        raw.rollback()
+        raw.close()
+
+
+def walk(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from walk(child)
+
+
+@pytest.mark.parametrize("path", PATHS)
+def test_route_plans(path):
+    # The first request may build in-memory indexes from full table reads.
+    client.get(path)
+    with captured_statements() as statements:
+        response = client.get(path, headers={"X-Read-Primary": "1"})
+    assert response.status_code in (200, 404)
+
+    for statement, parameters in statements:
+        plan = explain(statement, parameters)
+        seq_scans = {
+            node["Relation Name"] for node in walk(plan)
+            if node["Node Type"] == "Seq Scan"
+        } & LARGE_TABLES
+        seq_scans -= EXEMPT.get(path, set())
+        assert not seq_scans, f"{path} scans {seq_scans}:\n{statement}"
+        if not EXEMPT.get(path):
+            assert plan["Total Cost"] <= COST_BUDGET, f"{path} costs {plan['Total Cost']}:\n{statement}"
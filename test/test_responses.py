@@ -0,0 +1,45 @@
+from decimal import Decimal
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from src.api.responses import json_response, response_formats, table_response
+
+NAMES = ["movie_id", "movie_title", "imdb_rating"]
+ROWS = [(1, "alien", Decimal("8.5")), (2, "heat", None)]
+
+
+def test_rows_format():
+    response = table_response(NAMES, ROWS)
+    assert response.media_type == "application/json"
+    assert orjson.loads(response.body) == [
+        {"movie_id": 1, "movie_title": "alien", "imdb_rating": 8.5},
+        {"movie_id": 2, "movie_title": "heat", "imdb_rating": None},
+    ]
+
+
+def test_columnar_format():
+    response = table_response(NAMES, ROWS, response_formats.columnar)
+    assert orjson.loads(response.body) == {
+        "movie_id": [1, 2],
+        "movie_title": ["alien", "heat"],
+        "imdb_rating": [8.5, None],
+    }
+    empty = table_response(NAMES, [], response_formats.columnar)
+    assert orjson.loads(empty.body) == {"movie_id": [], "movie_title": [], "imdb_rating": []}
+
+
+def test_json_response_status():
+    assert json_response({"a": 1}, status_code=201).status_code == 201
+
+
+def test_json_response_matches_default_encoder():
+    # A page shaped like /characters/.
+    names = ["character_id", "character", "movie", "gender", "number_of_lines", "imdb_rating"]
+    rows = [(i, f"CHARACTER {i}", f"movie title {i % 40}", "M", i * 3, Decimal("7.5")) for i in range(250)]
+    default = orjson.loads(JSONResponse(jsonable_encoder([dict(zip(names, row)) for row in rows])).body)
+
+    assert orjson.loads(table_response(names, rows).body) == default
+    columnar = orjson.loads(table_response(names, rows, response_formats.columnar).body)
+    assert columnar == {name: [row[name] for row in default] for name in names}
@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+from src import database as db
+from src.singleflight import SingleFlight, coalesce
+
+
+def test_concurrent_calls_share_one_execution():
+    flights = SingleFlight()
+    calls = []
+
+    def slow_query():
+        calls.append(1)
+        time.sleep(0.2)
+        return ["result"]
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flights.do("key", slow_query)))
+        for _ in range(10)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [["result"]] * 10
+
+
+def test_errors_are_shared_and_not_cached():
+    flights = SingleFlight()
+
+    def failing_query():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        flights.do("key", failing_query)
+    assert flights.do("key", lambda: 42) == 42
+
+
+def test_reads_from_primary_do_not_join_flights():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    @coalesce()
+    def handler(id: int):
+        calls.append(db.read_from_primary.get())
+        if len(calls) == 1:
+            started.set()
+            release.wait(2)
+        return db.read_from_primary.get()
+
+    replica_read = threading.Thread(target=handler, args=(1,))
+    replica_read.start()
+    started.wait()
+
+    token = db.read_from_primary.set(True)
+    try:
+        assert handler(1) is True
+    finally:
+        db.read_from_primary.reset(token)
+        release.set()
+    replica_read.join()
+    assert calls == [False, True]
@@ -0,0 +1,37 @@
+from src.words import TermMatrix, WordIndex
+
+
+def make_index():
+    index = WordIndex()
+    index.movies = TermMatrix([], [], [])
+    index.characters = TermMatrix([], [], [])
+    index.add_lines(1, [(10, "the cat sat on the mat")])
+    index.add_lines(2, [(20, "the dog ran")])
+    index._compact()
+    return index
+
+
+def test_pending_rows_score_like_built_rows():
+    index = make_index()
+    # Same text as movie 1, plus a movie with words the ranking never saw.
+    index.add_lines(3, [(30, "the cat sat on the mat")])
+    index.add_lines(4, [(40, "entirely unseen words")])
+
+    built = index.summary(index.movies, 1, 10)
+    pending = index.summary(index.movies, 3, 10)
+    assert pending == built
+
+
+def test_compaction_merges_pending_counts():
+    index = make_index()
+    index.add_lines(1, [(10, "the cat")])
+    before = index.summary(index.movies, 1, 10)
+    index._compact()
+    after = index.summary(index.movies, 1, 10)
+
+    assert before["top_words"] == after["top_words"] == [
+        {"word": "the", "count": 3}, {"word": "cat", "count": 2},
+        {"word": "sat", "count": 1}, {"word": "on", "count": 1}, {"word": "mat", "count": 1},
+    ]
+    assert index.summary(index.characters, 10, 10)["total_words"] == 8
+    assert index.summary(index.movies, 99, 10) is None